@@ -0,0 +1,85 @@
+# EHR GPT - All Tasks
+# This script runs LLM and RegEx identification of sleep problems, LGBTQ+ identity, and prior hospitalizations in one run
+# The notes are loaded once and all tasks share one API client (instead of running each analysis script separately)
+# The prompts, patterns, and file names come from the analysis scripts (the task settings in each script)
+
+#Load Libraries
+import os #interact with the underlying operating system
+import asyncio # enables parallel processing
+import pandas as pd # handles spreadsheet data
+import argparse
+import ehr_gpt_funs as ehr # load internal functions defined in ehr_gpt_funs.py
+import ehr_gpt_sleep, ehr_gpt_lgbtq, ehr_gpt_priorhosp
+import ehr_gpt_sleep_0shot, ehr_gpt_lgbtq_0shot, ehr_gpt_priorhosp_0shot
+
+# time how long script takes to run (optional)
+import time
+start_time = time.time()  # Start timer
+# check max RAM usage (optional)
+import psutil
+process = psutil.Process(os.getpid())
+
+# Command line options
+parser = argparse.ArgumentParser(description="Identify notes with LLM + RegEx for several tasks at once")
+parser.add_argument("--tasks", nargs="+", default=["sleep", "lgbtq", "priorhosp"], choices=["sleep", "lgbtq", "priorhosp"],
+                    help="tasks to run (default: all)")
+parser.add_argument("--mode", choices=["few", "zero", "both"], default="few",
+                    help="few: the k-shot prompts on the cleaning output (default); zero: the zero-shot prompts on ../data/all_ehr.csv "
+                         "(as the _0shot scripts); both: run both in the same run (shared client and label cache)")
+parser.add_argument("--zeroshot", action="store_true",
+                    help="same as --mode zero")
+parser.add_argument("--online", action="store_true",
+                    help="zero-shot prompts: call the API directly instead of through the OpenAI Batch API (~50%% cheaper, results within 24 hours)")
+parser.add_argument("--fuse", action="store_true",
+                    help="answer all the tasks in one LLM call per note (group of notes) instead of one call per task (see ehr.run_tasks_fused)")
+args = parser.parse_args()
+
+# Get the directory where this script is located
+script_dir = os.path.dirname(os.path.abspath(__file__))
+
+# The analysis script for each task, for each prompt variant (k-shot or zero-shot)
+scripts = {"few": {"sleep": ehr_gpt_sleep, "lgbtq": ehr_gpt_lgbtq, "priorhosp": ehr_gpt_priorhosp},
+           "zero": {"sleep": ehr_gpt_sleep_0shot, "lgbtq": ehr_gpt_lgbtq_0shot, "priorhosp": ehr_gpt_priorhosp_0shot}}
+mode = "zero" if args.zeroshot else args.mode
+modes = ["few", "zero"] if mode == "both" else [mode]
+
+# Stop now if a file or a needed column is missing (before any API calls)
+for m in modes:
+    tasks = [scripts[m][name].task for name in args.tasks]
+    ehr.check_input(scripts[m][args.tasks[0]].input_file,
+                    (["note"] if m == "zero" else []) + ["CleanNote6"] + [task["truth_col"] for task in tasks])
+
+# Load each prompt variant's CSV file into a pandas DataFrame (once, for all its tasks)
+def load_notes(m):
+    df = pd.read_csv(scripts[m][args.tasks[0]].input_file, engine="pyarrow", dtype_backend="pyarrow")  # the same input file for all tasks
+    # The cleaning output only has a hash of each raw note (note_sha), unless it was run with --debug-intermediates
+    # Get the raw notes, used for the RegEx search, from the cleaning input file
+    if "note" not in df.columns:
+        df = ehr.add_raw_notes(df, os.path.join(script_dir, "../data/input.csv"))
+    return df
+dfs = {m: load_notes(m) for m in modes}
+
+# Run all tasks (of both prompt variants with --mode both) at the same time with the shared client;
+# each task saves its own results (see ehr.run_task), and labels already in the label cache (ehr.get_label_cache) are not requested again
+# The cleaning output scripts always call the API directly; the zero-shot ones use the Batch API unless --online is given
+# With --fuse, each note is sent once with the instructions of all tasks, and the LLM answers every task in the same response
+async def run_all_tasks():
+    jobs = []
+    for m in modes:
+        tasks = [scripts[m][name].task for name in args.tasks]
+        online = args.online or m == "few"
+        if args.fuse:
+            jobs.append(ehr.run_tasks_fused(dfs[m], tasks, online=online, batch_dir=os.path.join(script_dir, "../data"),
+                                            max_concurrent=ehr.max_concurrent))
+        else:
+            jobs += [ehr.run_task(dfs[m], task, online=online, batch_dir=os.path.join(script_dir, "../data"),
+                                  max_concurrent=ehr.max_concurrent) for task in tasks]
+    return await asyncio.gather(*jobs)
+ehr.run_with_client(run_all_tasks())
+
+end_time = time.time()    # End timer
+print(f"Script runtime: {end_time - start_time:.2f} seconds")
+mem_info = process.memory_info()
+print(f"Peak memory usage: {mem_info.rss / (1024 ** 2):.2f} MB")
+cpu_percent = process.cpu_percent(interval=1.0)
+print(f"CPU usage: {cpu_percent}%")
@@ -2,44 +2,156 @@
 # David Pagliaccio
 # Feb 17, 2026
 # This script aims to cleans Electronic Health Record (EHR) psychiatric notes by removing boilerplate text, administrative content, and standardized templates while preserving the actual clinical narrative.
-# The cleaning is run in 6 serial steps to provide a smaller task within each call
+# The cleaning tasks are grouped into 6 phases; by default all 6 are sent to GPT in a single combined call per note
+# (set clean_mode = "phased" to run the 6 phases as serial steps, each with a smaller task, as in the manuscript,
+# or clean_mode = "spans" to run the phases in parallel, each returning the text to remove)
 # The API is called using parallel processing to speed up completion time
+# Run with --offline to send all notes through the OpenAI Batch API instead (~50% cheaper, results within 24 hours)
 
 #Load Libraries
+import openai # error types used for retries
 from openai import AsyncOpenAI # connects to OpenAI's GPT API
 import os #interact with the underlying operating system
+import httpx # HTTP connection pool used by the OpenAI client
 import pandas as pd # handles spreadsheet data
+import pyarrow as pa # column types for the output files
+import pyarrow.parquet as pq # writes the Parquet output file
+import pyarrow.csv as pacsv # writes the CSV output file (faster than pandas to_csv)
 import asyncio # enables parallel processing
+import json # writes each cleaned note to the results file as soon as it is done
+import re # quick keyword checks to skip phases that have nothing to remove
+import argparse # command line options
 from tqdm.asyncio import tqdm_asyncio # shows progress bars (optional)
+import ehr_gpt_funs as ehr # load internal functions defined in ehr_gpt_funs.py
+import diskcache # saves GPT responses on disk so repeated calls are free
+from tenacity import retry, stop_after_attempt, wait_random_exponential, retry_if_exception_type # retries failed API calls
+
+# Command line options
+parser = argparse.ArgumentParser(description="Clean EHR notes with GPT")
+parser.add_argument("--offline", action="store_true",
+                    help="use the OpenAI Batch API (~50%% cheaper, no rate limits, but results can take up to 24 hours)")
+parser.add_argument("--debug-intermediates", action="store_true",
+                    help="keep the raw note (and in phased mode CleanNote1-CleanNote5) in the output files")
+parser.add_argument("--profile", action="store_true",
+                    help="report the peak memory used by Python during the run (makes the run slower)")
+parser.add_argument("--mini-phases", action="store_true",
+                    help="run phases 1, 2, 3, and 6 on gpt-4o-mini instead of gpt-4o (cheaper and faster; check the output on a sample of notes first)")
+args = parser.parse_args()
 
 # time how long script takes to run (optional)
 import time
-start_time = time.time()  # Start timer
-# check max RAM usage (optional)
-import psutil
-process = psutil.Process(os.getpid())
+start_time = time.perf_counter()  # Start timer
+# check peak RAM usage (only with --profile; tracemalloc records every allocation, which slows the script down)
+# tracemalloc reports the true peak during the run, not just the memory in use at the end
+if args.profile:
+    import tracemalloc
+    tracemalloc.start()
 
 # Set your OpenAI API key from environment variable ** Make sure OPENAI_API_KEY is set before running this script
 # e.g., if launching from bash, can add OPENAI_API_KEY to ~/.bashrc
 # alternatively just add the the key in script here
-client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# The client is created by make_client() once the event loop is running (see clean_file below)
+client = None
+
+# Maximum number of open connections to the API (raise if OPENAI_RPM allows many more calls at once)
+max_connections = int(os.getenv("OPENAI_MAX_CONNECTIONS", "200"))
+
+# FUNCTION: make_client - Creates the OpenAI client with a connection pool sized for many parallel calls
+# Connections are kept open and reused between calls instead of opening a new one for each call
+# (httpx defaults allow only 100 connections and 20 kept open); HTTP/2 sends many calls over each connection
+# max_retries=0 because failed calls are retried by call_gpt (see below)
+def make_client():
+    http_client = httpx.AsyncClient(http2=True, limits=httpx.Limits(max_connections=max_connections,
+                                                                    max_keepalive_connections=max_connections),
+                                    timeout=httpx.Timeout(120, connect=10))  # give up on a hung call after 2 minutes (it is then retried)
+    return AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), http_client=http_client, max_retries=0)
+
+# Set your account's rate limits (requests per minute and tokens per minute) from environment variables
+# See https://platform.openai.com/account/limits - the defaults below are the lowest (tier 1) limits for GPT-4o
+# API calls are sent as fast as these limits allow, rather than a fixed number at a time
+# (after the first response, the limits reported by the API are used instead, see ehr.RateLimiter.update_from_headers)
+rate_limiter = ehr.RateLimiter(max_requests_per_minute=int(os.getenv("OPENAI_RPM", "500")),
+                               max_tokens_per_minute=int(os.getenv("OPENAI_TPM", "30000")))
 
 # Get the directory where this script is located
 script_dir = os.path.dirname(os.path.abspath(__file__))
 
-# Build the path to your input CSV file (relative to script location)
-input_file = os.path.join(script_dir, "/data/input.csv")
-
-# Load the CSV file into a pandas DataFrame
-df = pd.read_csv(input_file)
+# Cache of GPT responses, saved in the ../data/gpt_cache folder (with the other data files, as it holds note text)
+# A call with the exact same instructions + prompt + note (a duplicate note, or a re-run) uses the saved response
+# Delete the folder to force all notes to be sent to GPT again
+gpt_cache = diskcache.Cache(os.path.join(script_dir, "../data/gpt_cache"))
 
-# Create 6 new empty columns to store the output from each cleaning phase
-df["CleanNote1"] = ""  # After phase 1: headers removed
-df["CleanNote2"] = ""  # After phase 2: signatures removed
-df["CleanNote3"] = ""  # After phase 3: labs/vitals removed
-df["CleanNote4"] = ""  # After phase 4: MSE removed
-df["CleanNote5"] = ""  # After phase 5: screening tools removed
-df["CleanNote6"] = ""  # After phase 6: final cleanup (duplicates, N/A fields, etc.)
+# Build the path to your input CSV file (relative to script location)
+input_file = os.path.join(script_dir, "../data/input.csv")
+# Stop now if the file or the note column is missing (before any API calls)
+ehr.check_input(input_file, ["note"])
+
+# The CSV file is read and cleaned in chunks of this many notes (see MAIN EXECUTION below)
+# so memory use stays the same no matter how many notes are in the file
+# Larger chunks keep more API calls going at once (up to the OPENAI_RPM / OPENAI_TPM limits), smaller chunks use less memory
+# With --offline each chunk is one batch job (one per phase in "phased" mode, two in "spans" mode), so the default chunk is much larger
+chunk_size = int(os.getenv("CHUNK_SIZE", "50000" if args.offline else "1000"))
+
+# How the 6 cleaning phases are run:
+#   - "combined": one combined call per note that returns the cleaned note
+#     (1 round-trip instead of 6 and the note is sent as input only once, but only returns the final cleaned note)
+#   - "phased": 6 separate serial calls, each phase cleaning the output of the previous one - use if the intermediate phase outputs are needed
+#   - "spans": phases 1, 2, 3, 5, and 6 run at the same time on the note and each returns the text to remove (JSON), then phase 4 (MSE) runs
+#     on the result; the wait per note is the slowest phase instead of the sum of all phases, and GPT only returns the removed text
+clean_mode = "combined"
+
+# Output columns from each cleaning phase
+# CleanNote1: After phase 1: headers removed
+# CleanNote2: After phase 2: signatures removed
+# CleanNote3: After phase 3: labs/vitals removed
+# CleanNote4: After phase 4: MSE removed
+# CleanNote5: After phase 5: screening tools removed
+# CleanNote6: After phase 6: final cleanup (duplicates, N/A fields, etc.)
+if clean_mode == "phased":
+    output_cols = ["CleanNote1", "CleanNote2", "CleanNote3", "CleanNote4", "CleanNote5", "CleanNote6"]
+else:
+    output_cols = ["CleanNote6"]  # combined and spans modes only return the final cleaned note
+
+# Each cleaned note is appended to this JSONL file (one line per note) as soon as it finishes,
+# so a crash or stopped run loses nothing: re-running the script skips the notes already in the file
+# Each line has the row index and a hash of the raw note (note_sha, see ehr.note_hash); a line is only used
+# for the same note at the same row (see done_record), so a replaced or reordered input file never gets another note's text
+results_file = os.path.join(script_dir, "../data/cleaned_output.jsonl")
+
+# FUNCTION: index_results - Finds each row's line in the results file, without keeping the cleaned notes in memory
+# Returns {row index: (note_sha, byte offset of the line)}; a later line for the same row replaces an earlier one,
+# and an unfinished last line (from a crash) is skipped
+def index_results(path):
+    index = {}
+    if not os.path.exists(path):
+        return index
+    with open(path, "rb") as f:
+        offset = 0
+        for line in f:
+            try:
+                record = json.loads(line)
+                index[record["idx"]] = (record.get("note_sha"), offset)
+            except json.JSONDecodeError:
+                pass
+            offset += len(line)
+    return index
+
+done_results = index_results(results_file)
+if done_results:
+    print(f"Resuming: {len(done_results)} notes in {results_file} (used where the note at that row is unchanged)")
+
+# FUNCTION: is_done - True if the results file has this row, for this same note
+def is_done(idx, note):
+    entry = done_results.get(idx)
+    return entry is not None and entry[0] is not None and entry[0] == ehr.note_hash(note)
+
+# FUNCTION: done_record - Returns the results file line for this row (read from done_file, the results file opened in
+# binary mode), or None if there is none or it was for a different note
+def done_record(done_file, idx, note):
+    if not is_done(idx, note):
+        return None
+    done_file.seek(done_results[idx][1])
+    return json.loads(done_file.readline())
 
 # SYSTEM INSTRUCTIONS - These are the "rules" given to GPT for EVERY API call
 # This defines GPT's role and behavior: what it should and shouldn't do
@@ -60,10 +172,29 @@ DO:
 - After applying all tasks, re-check the note to ensure no examples remain.
 - Leave the note unchanged if no matching content is found
 
-Return only the cleaned note as plain text. Do not include explanations, tags, or metadata.
+Return only the cleaned note, in the "cleaned" field of the JSON output. Do not include explanations, tags, or metadata.
 
 """
 
+# SYSTEM INSTRUCTIONS FOR "spans" MODE - Same rules, but GPT lists the text to remove instead of returning the cleaned note
+spans_system_content = system_content.replace(
+    'Return only the cleaned note, in the "cleaned" field of the JSON output. Do not include explanations, tags, or metadata.',
+    'Do not return the cleaned note. Instead return a JSON object {"remove": [...]} listing every piece of text that should be removed, '
+    'each copied exactly, character for character, from the note. Return {"remove": []} if nothing should be removed.')
+
+# OUTPUT FORMATS - GPT must return a JSON object matching these schemas (structured outputs, strict),
+# so a reply like "Here is the cleaned note: ..." or a note wrapped in markdown can't end up in the output
+cleaned_format = {"type": "json_schema",
+                  "json_schema": {"name": "cleaned_note", "strict": True,
+                                  "schema": {"type": "object",
+                                             "properties": {"cleaned": {"type": "string"}},
+                                             "required": ["cleaned"], "additionalProperties": False}}}
+spans_format = {"type": "json_schema",
+                "json_schema": {"name": "removed_text", "strict": True,
+                                "schema": {"type": "object",
+                                           "properties": {"remove": {"type": "array", "items": {"type": "string"}}},
+                                           "required": ["remove"], "additionalProperties": False}}}
+
 # PHASE 1 PROMPT - Removes administrative headers and boilerplate
 # This phase targets document headers, telehealth disclaimers, interpreter statements, and contact tables
 phase_1_prompt = """
@@ -222,96 +353,538 @@ phase_6_prompt = f"""
 Note:
 """
 
-# FUNCTION: call_gpt - Makes a single API call to GPT-4o
+# COMBINED PROMPT - All 6 phases in a single prompt (see build_combined_prompt below)
+# The task block of each phase prompt (without its closing reminder and "Note:" line) is added under a numbered section header
+# so GPT can apply every removal task in one call and return only the final cleaned note
+phase_prompts = [phase_1_prompt, phase_2_prompt, phase_3_prompt, phase_4_prompt, phase_5_prompt, phase_6_prompt]
+phase_titles = ["Headers", "Signatures", "Labs/Vitals", "Mental Status Exam", "Screening Tools", "Final Cleanup"]
+
+def task_block(phase_prompt):
+    # Keep only the numbered tasks/examples of a phase prompt
+    block = phase_prompt.split("*NEVER rewrite")[0]
+    return block.replace("**Tasks**", "").replace("**Task**", "").strip()
+
+# PHASE TRIGGERS - Cheap keyword checks to skip phases that have nothing to remove
+# If none of a phase's trigger words are in the note, the phase is skipped and the note is passed through unchanged
+# (the system prompt asks GPT to leave the note unchanged in that case anyway, so the API call is wasted)
+# Triggers are built from the examples in each phase prompt and are deliberately broad: a false hit only costs an API call,
+# a miss leaves boilerplate in the note - add keywords here if new templates show up in the notes
+phase_triggers = {
+    1: re.compile(r"telehealth|telemedicine|telepsychiatry|Avizia|interpreter|CPEP|EVALUATION NOTE|Initial Psychiatric Evaluation|"
+                  r"Provider Name|Relations Phone|Care Team", re.IGNORECASE),
+    2: re.compile(r"electronically signed|signed electronically|electronic signature|Attestation|attending physician|SmartPhrase|"
+                  r"NYP Connect|Share w/ Patient|release of this note|Completed by|PPE|SARS-CoV-2 positive", re.IGNORECASE),
+    3: re.compile(r"CBC|PANEL|URINALYSIS|URINE|DRUG SCREEN|NAAT|Lab results|Labs Reviewed|Result Value|Vitals|"
+                  r"Review of Systems|\bROS\b|Physical Exam", re.IGNORECASE),
+    4: re.compile(r"Mental Status Exam|Appearance:|Hygiene/Grooming:|Attitude:|Eye Contact:|Speech:|Mood:|Affect:|"
+                  r"Thought Process:|Thought Content:|Insight:|Judgement:"),
+    5: re.compile(r"CRAFFT|C-SSRS|CSSRS|SAFE-T|SAFE - T|Safety Plan|Substance Use Screening", re.IGNORECASE),
+    6: re.compile(r"Disposition|Plan:|Allerg|NKDA|Firearms|N/A|Not on file|No data to display|Not applicable|"
+                  r"No orders to display|documented", re.IGNORECASE),
+}
+
+# Phase 6 also removes duplicated text, which has no keyword - check for any sentence that appears more than once
+def has_duplicate_sentences(text):
+    sentences = [s.strip().lower() for s in re.split(r"(?<=[.!?])\s+", text) if len(s.strip()) > 20]
+    return len(sentences) != len(set(sentences))
+
+# Removes all but the first copy of any sentence that appears more than once (same check as has_duplicate_sentences)
+# Used in "spans" mode, where removing a duplicated sentence returned by GPT would remove every copy of it
+def remove_duplicate_sentences(text):
+    pieces = re.split(r"((?<=[.!?])\s+)", text)  # sentences, with the whitespace after each one kept as separate pieces
+    seen = set()
+    kept = []
+    for i in range(0, len(pieces), 2):
+        sentence, after = pieces[i], "".join(pieces[i + 1:i + 2])
+        key = sentence.strip().lower()
+        if len(key) > 20 and key in seen:
+            continue
+        seen.add(key)
+        kept.append(sentence + after)
+    return "".join(kept)
+
+# Returns True if the phase (1-6) could have something to remove from this text
+def phase_triggered(phase, text):
+    if phase_triggers[phase].search(text):
+        return True
+    return phase == 6 and has_duplicate_sentences(text)
+
+# BOILERPLATE FAST PATH - Removes known template text locally, before any GPT call
+# Many of the examples in phases 1, 2, and 6 are fixed template strings (telehealth disclaimers, NYP Connect text, "Allergies: NKDA", ...)
+# These are taken straight from the example lists of those phase prompts and removed with a single regex pass,
+# so GPT only has to handle the rest (examples with made-up names/IDs or [placeholders] are patterns, not literal text, and are left to GPT)
+# Matching ignores case and treats any run of whitespace as a space
+example_pattern = re.compile(r'^\s*- "(.+)"\s*$', re.MULTILINE)
+placeholder_pattern = re.compile(r"\[|Jane Smith|John Jones|#\d")
+boilerplate_strings = [example for prompt in (phase_1_prompt, phase_2_prompt, phase_6_prompt)
+                       for example in example_pattern.findall(prompt)
+                       if '", "' not in example and not placeholder_pattern.search(example)]
+
+def literal_regex(text):
+    # Escape the text and allow any whitespace between words; don't match inside a longer word
+    regex = r"\s+".join(re.escape(word) for word in text.split())
+    if text[0].isalnum():
+        regex = r"(?<!\w)" + regex
+    if text[-1].isalnum():
+        regex += r"(?!\w)"
+    return regex
+
+# Longest strings first so a long template is removed whole; also removes a following ./;/, and spaces/tabs after each match
+boilerplate_pattern = re.compile("(?:" + "|".join(literal_regex(text) for text in sorted(boilerplate_strings, key=len, reverse=True))
+                                 + r")[.;,]?[ \t]*", re.IGNORECASE)
+
+def remove_boilerplate(note):
+    return boilerplate_pattern.sub("", note)
+
+# TOKEN COUNTS - Input tokens are counted before each call (same tokenizer as gpt-4o and gpt-4o-mini)
+# The counts are used by the rate limiter and totalled for the whole run (printed at the end) to spot pathological notes
+# (the tokenizer is loaded by ehr.count_tokens on first use)
+token_counts = {"calls": 0, "input_tokens": 0, "largest_call": 0}
+
+def count_tokens(text):
+    return ehr.count_tokens(text)
+
+# The system instructions (system_content or spans_system_content) are the same for every call, so each is only counted once
+def count_system_tokens(system):
+    return ehr.count_prompt_tokens(system)
+
+# Add one call's input tokens to the run totals
+def log_tokens(n_tokens):
+    token_counts["calls"] += 1
+    token_counts["input_tokens"] += n_tokens
+    token_counts["largest_call"] = max(token_counts["largest_call"], n_tokens)
+
+# LONG NOTES - Notes longer than this many tokens are split and each part is cleaned separately
+# GPT returns the whole cleaned note, and gpt-4o can return at most 16,384 tokens, so longer notes would come back cut off
+max_note_tokens = int(os.getenv("MAX_NOTE_TOKENS", "12000"))
+
+# FUNCTION: split_note - Splits a note into parts of at most max_tokens tokens
+# The note is cut in two at the paragraph (or line, sentence, word) break closest to the middle, and each half is split again if needed
+def split_note(note, max_tokens):
+    if count_tokens(note) <= max_tokens:
+        return [note]
+    middle = len(note) // 2
+    cut = middle
+    for sep in ("\n\n", "\n", ". ", " "):
+        breaks = [i + len(sep) for i in (note.rfind(sep, 0, middle), note.find(sep, middle)) if 0 < i < len(note) - len(sep)]
+        if breaks:
+            cut = min(breaks, key=lambda i: abs(i - middle))
+            break
+    return split_note(note[:cut], max_tokens) + split_note(note[cut:], max_tokens)
+
+# PHASE MODELS - Which GPT model runs each phase
+# All phases run on gpt-4o by default, as in the manuscript
+# With --mini-phases, phases 1, 2, 3, and 6 (mostly structural removals of templated text) run on the smaller, cheaper, and faster
+# gpt-4o-mini; phases 4 (structured vs unstructured MSE) and 5 (screening tools and safety plans) need more judgement and stay on gpt-4o
+# Check that outputs match gpt-4o on a sample of notes (e.g. 100) before using --mini-phases for a full run
+phase_models = {phase: "gpt-4o" for phase in range(1, 7)}
+if args.mini_phases:
+    phase_models.update({1: "gpt-4o-mini", 2: "gpt-4o-mini", 3: "gpt-4o-mini", 6: "gpt-4o-mini"})
+
+# The combined prompt for several phases uses gpt-4o if any of those phases need it
+def combined_model(phases):
+    return "gpt-4o" if any(phase_models[phase] == "gpt-4o" for phase in phases) else "gpt-4o-mini"
+
+# FUNCTION: build_combined_prompt - Combines the task blocks of the given phases into one prompt
+# Parameter: phases - list of phase numbers (1-6) to include
+def build_combined_prompt(phases):
+    prompt = "**Tasks**\nApply every Task Group below, in order, to the note. Return only the final cleaned note after all Task Groups are applied.\n\n"
+    prompt += "\n\n".join(f"### Task Group {i}: {phase_titles[i - 1]}\n{task_block(phase_prompts[i - 1])}" for i in phases)
+    prompt += """
+
+*NEVER rewrite, paraphrase, summarize, duplicate, or reorder the text*
+
+Note:
+"""
+    return prompt
+
+# FUNCTION: call_gpt - Gets the GPT response for a prompt, from the cache if this call was made before
 # Parameters:
 #   - prompt: The user message (phase prompt + note text)
 #   - system_content: The system instructions (how GPT should behave)
-# Returns: The cleaned text from GPT
+#   - model: The GPT model to use (see phase_models)
+#   - response_format: The output format (cleaned_format, or spans_format in "spans" mode)
+# Returns: The JSON text from GPT (read it with parse_cleaned / parse_spans)
+async def call_gpt(prompt, system_content, model="gpt-4o", response_format=cleaned_format):
+    key = ehr.cache_key(model, system_content, prompt, json.dumps(response_format))
+    return await ehr.cached_call(gpt_cache, key, lambda: request_gpt(prompt, system_content, model, response_format))
+
+# FUNCTION: request_gpt - Makes a single API call to GPT
+# Parameters: same as call_gpt
+# Returns: The JSON text from GPT
 # Note: async allows this function to run in parallel with other API calls
-# SET MODEL TO GPT 4o
+# SET MODEL PER PHASE IN phase_models
 # SET TEMPERATURE TO 0 (default=1)
-async def call_gpt(prompt, system_content):
-    # Make async API call to OpenAI's GPT-4o model
-    response = await client.chat.completions.create(
-        model="gpt-4o",  # Using GPT-4o (can change to other GPT options)
+# Calls that fail from rate limits, connection problems, timeouts, or OpenAI server errors are retried up to 8 times,
+# waiting a random, exponentially growing time (up to 60 seconds) between attempts, so one failure doesn't lose the note
+@retry(wait=wait_random_exponential(min=1, max=60), stop=stop_after_attempt(8), reraise=True,
+       retry=retry_if_exception_type((openai.RateLimitError, openai.APIConnectionError,
+                                      openai.APITimeoutError, openai.InternalServerError)))
+async def request_gpt(prompt, system_content, model, response_format):
+    # Wait for room under the RPM/TPM limits
+    # Token estimate: input tokens, plus room for the returned note
+    n_tokens = count_system_tokens(system_content) + count_tokens(prompt)
+    log_tokens(n_tokens)
+    await rate_limiter.acquire(n_tokens + 512)
+    # Make async API call to OpenAI's GPT model
+    # with_raw_response gives access to the rate limit headers, .parse() returns the usual response
+    raw_response = await client.chat.completions.with_raw_response.create(
+        model=model,  # GPT-4o or GPT-4o-mini (can change to other GPT options)
         messages=[{"role": "system", "content": system_content},  # The rules/behavior
                   {"role": "user", "content": prompt}],            # The task + note
-        temperature=0  # Deterministic output (same input always gives same output)
+        temperature=0,  # Deterministic output (same input always gives same output)
+        response_format=response_format  # JSON output that matches the schema
     )
+    rate_limiter.update_from_headers(raw_response.headers)
+    response = raw_response.parse()
     # Extract the text from the response and remove leading/trailing whitespace
     return response.choices[0].message.content.strip()
 
+# FUNCTION: parse_cleaned - Reads the cleaned note from a GPT response (cleaned_format)
+# Raises ValueError if the response is not the expected JSON (e.g. cut off at the output token limit), so the note fails
+# and is tried again on the next run instead of writing a broken note
+def parse_cleaned(response_text):
+    try:
+        return json.loads(response_text)["cleaned"].strip()
+    except (json.JSONDecodeError, KeyError, TypeError, AttributeError):
+        raise ValueError(f"Could not read the cleaned note: {response_text[:200]}")
+
 # FUNCTION: multi_step_clean - Processes a single note through all 6 phases sequentially
 # Parameter: note - The original raw EHR note text
 # Returns: 6 outputs (one from each phase)
 # Each phase takes the output of the previous phase as input
+# Known template strings are removed locally first (see remove_boilerplate), so they are already gone from CleanNote1
+# Phases with no trigger words in the current text are skipped (output = input)
+# Each phase runs on its own model from phase_models
 async def multi_step_clean(note):
-    phase_1_output = await call_gpt(phase_1_prompt + note, system_content)
-    phase_2_output = await call_gpt(phase_2_prompt + phase_1_output, system_content)
-    phase_3_output = await call_gpt(phase_3_prompt + phase_2_output, system_content)
-    phase_4_output = await call_gpt(phase_4_prompt + phase_3_output, system_content)
-    phase_5_output = await call_gpt(phase_5_prompt + phase_4_output, system_content)
-    phase_6_output = await call_gpt(phase_6_prompt + phase_5_output, system_content)
-    return phase_1_output,phase_2_output,phase_3_output,phase_4_output,phase_5_output, phase_6_output
-
-# FUNCTION: process_all_notes - Processes all notes in parallel with concurrency control
-# Parameters:
-#   - df: The pandas DataFrame containing all notes
-#   - max_concurrent: Maximum number of simultaneous API calls (default 10 - can increase depending on capacity/need)
-# This function enables parallel processing while respecting API rate limits
-async def process_all_notes(df, max_concurrent):
-    # Semaphore limits how many API calls can run simultaneously
-    semaphore = asyncio.Semaphore(max_concurrent)
-
-    # Inner function to process a single note with semaphore control
+    outputs = []
+    current = remove_boilerplate(note)
+    for phase, phase_prompt in enumerate(phase_prompts, start=1):
+        if phase_triggered(phase, current):
+            current = parse_cleaned(await call_gpt(phase_prompt + current, system_content, phase_models[phase]))
+        outputs.append(current)
+    return tuple(outputs)
+
+# FUNCTION: single_step_clean - Processes a single note through all 6 phases in one API call
+# Parameter: note - The original raw EHR note text
+# Returns: 1 output (the final cleaned note, equivalent to phase 6 output)
+# Known template strings are removed locally first (see remove_boilerplate)
+# Only the phases with trigger words in the note are included in the prompt; if there are none, no API call is made
+# gpt-4o-mini is used when none of the included phases need gpt-4o
+async def single_step_clean(note):
+    note = remove_boilerplate(note)
+    phases = [phase for phase in range(1, 7) if phase_triggered(phase, note)]
+    if not phases:
+        return (note.strip(),)
+    cleaned_output = parse_cleaned(await call_gpt(build_combined_prompt(phases) + note, system_content, combined_model(phases)))
+    return (cleaned_output,)
+
+# FUNCTION: parse_spans - Reads the list of text to remove from a "spans" mode response
+def parse_spans(response_text):
+    try:
+        spans = json.loads(response_text).get("remove", [])
+    except (json.JSONDecodeError, TypeError, AttributeError):
+        raise ValueError(f"Could not read the list of text to remove: {response_text[:200]}")
+    return [span for span in spans if isinstance(span, str) and span.strip()]
+
+# FUNCTION: remove_spans - Removes every returned piece of text from the note
+# Longest first, so a piece that contains a shorter one is removed whole; text GPT returned that is not in the note is ignored
+def remove_spans(note, spans):
+    for span in sorted(set(spans), key=len, reverse=True):
+        note = note.replace(span, "")
+    return note.strip()
+
+# Phases run in parallel in "spans" mode; phase 4 (structured MSE) runs after them on the result
+parallel_phases = [1, 2, 3, 5, 6]
+
+# FUNCTION: spans_clean - Processes a single note with the phases in parallel, each returning the text to remove ("spans" mode)
+# Parameter: note - The original raw EHR note text
+# Returns: 1 output (the final cleaned note)
+# Known template strings and duplicated sentences are removed locally first; phases with no trigger words are skipped
+async def spans_clean(note):
+    note = remove_duplicate_sentences(remove_boilerplate(note))
+    phases = [phase for phase in parallel_phases if phase_triggered(phase, note)]
+    responses = await asyncio.gather(*[call_gpt(phase_prompts[phase - 1] + note, spans_system_content,
+                                                phase_models[phase], spans_format) for phase in phases])
+    note = remove_spans(note, [span for response in responses for span in parse_spans(response)])
+    if phase_triggered(4, note):
+        response = await call_gpt(phase_4_prompt + note, spans_system_content, phase_models[4], spans_format)
+        note = remove_spans(note, parse_spans(response))
+    return (note,)
+
+# FUNCTION: clean_note - Cleans a single note (using clean_mode), splitting it first if it is too long
+# Returns: the output(s) of multi_step_clean / single_step_clean / spans_clean; for a split note, the cleaned parts are joined by line breaks
+async def clean_note(note):
+    clean = {"phased": multi_step_clean, "combined": single_step_clean, "spans": spans_clean}[clean_mode]
+    parts = split_note(note, max_note_tokens)
+    if len(parts) == 1:
+        return await clean(note)
+    part_outputs = await asyncio.gather(*[clean(part) for part in parts])
+    return tuple("\n".join(outputs) for outputs in zip(*part_outputs))
+
+# FUNCTION: process_all_notes - Processes all notes in parallel
+# Parameter: df - The pandas DataFrame containing the notes (one chunk of the input file)
+# Returns: dict of the new results by row index ({"idx": ..., "CleanNote6": ...}), also written to the results file
+# This function enables parallel processing while respecting API rate limits (rate_limiter, set above)
+async def process_all_notes(df):
+    # Inner function to process a single note
     async def process_note(idx, note):
-        async with semaphore:  # Wait for a token, then proceed
-            try:
-                # Run all 6 phases sequentially on this note
-                outputs = await multi_step_clean(note)
-                return idx, outputs  # Return the row index and all 6 outputs
-            except Exception as e:
-                # If this note fails, print error but don't crash the whole script
-                print(f"Error at row {idx}: {e}")
-                return idx, (None, None, None, None, None, None)  # Return None for failed note
-    # Create a task (async job) for each note in the dataframe
-    # This starts all the cleaning processes, but limited by the semaphore
+        try:
+            # Run all 6 phases on this note, either sequentially or in a single combined call
+            outputs = await clean_note(note)
+            return idx, outputs  # Return the row index and the output(s)
+        except Exception as e:
+            # If this note fails, print error but don't crash the whole script
+            print(f"Error at row {idx}: {e}")
+            return idx, (None,) * len(output_cols)  # Return None for failed note
+    # Create a task (async job) for each note in the dataframe that is not already in the results file
+    # This starts all the cleaning processes, each API call waits for the rate limiter
     # SET "note" as the name of the name of the input column for the raw data
-    tasks = [process_note(idx, row["note"]) for idx, row in df.iterrows()]
-    
+    # (zip over the index and note arrays avoids building a pandas Series for every row, as iterrows() does)
+    notes = [(int(idx), note) for idx, note in zip(df.index.to_numpy(), df["note"].to_numpy())
+             if not is_done(int(idx), note)]
+    # Start the longest notes first, so the short ones fill in the gaps at the end
+    # instead of a few long notes still running after everything else is done
+    # (tasks are created in this order, and the rate limiter lets them through in the order they ask)
+    notes.sort(key=lambda item: len(item[1]) if isinstance(item[1], str) else 0, reverse=True)
+    tasks = [asyncio.ensure_future(process_note(idx, note)) for idx, note in notes]
+
     # Process tasks as they complete and show progress bar
-    results = []
-    for coro in tqdm_asyncio.as_completed(tasks, total=len(tasks), desc="Cleaning Notes"):
-        result = await coro  # Wait for this task to finish
-        results.append(result)  # Collect the result
-
-    # Write all the results back to the dataframe
-    # Loop through results and assign to the appropriate row and column
-    for idx, (p1, p2, p3, p4, p5, p6) in results:
-        df.at[idx, "CleanNote1"] = p1  # Phase 1 output
-        df.at[idx, "CleanNote2"] = p2  # Phase 2 output
-        df.at[idx, "CleanNote3"] = p3  # Phase 3 output
-        df.at[idx, "CleanNote4"] = p4  # Phase 4 output
-        df.at[idx, "CleanNote5"] = p5  # Phase 5 output
-        df.at[idx, "CleanNote6"] = p6  # Final cleaned note
+    # Each finished note is written straight to the results file (CleanNote6 is always the final cleaned note)
+    # Failed notes are not written, so they are tried again on the next run
+    new_results = {}
+    raw_notes = dict(notes)
+    with open(results_file, "a", encoding="utf-8") as f:
+        for coro in tqdm_asyncio.as_completed(tasks, total=len(tasks), desc="Cleaning Notes"):
+            idx, outputs = await coro  # Wait for this task to finish
+            if outputs[-1] is None:
+                continue
+            new_results[idx] = write_result(f, idx, raw_notes[idx], outputs)
+    return new_results
+
+# FUNCTION: write_result - Writes one cleaned note (with the hash of its raw note) to the results file, returns the record
+def write_result(f, idx, note, outputs):
+    record = {"idx": idx, "note_sha": ehr.note_hash(note), **dict(zip(output_cols, outputs))}
+    f.write(json.dumps(record) + "\n")
+    f.flush()  # make sure the line is on disk before moving on
+    return record
+
+# FUNCTION: batch_gpt - Gets GPT responses for many prompts at once through the Batch API (--offline)
+# Parameters:
+#   - requests: dict of {request key: (prompt, model)}, where the key is a tuple such as (row index, part number)
+#   - system: The system instructions for all requests (system_content, or spans_system_content in "spans" mode)
+#   - response_format: The output format for all requests (as in call_gpt)
+# Returns: dict of {request key: GPT response text, or None if the request failed}
+# Responses already in the cache are used directly; only the rest are sent in the batch,
+# and identical requests (same cache key, e.g. identical notes) are sent once and share the response
+async def batch_gpt(requests, system=system_content, response_format=cleaned_format):
+    responses, keys, bodies, custom_ids = {}, {}, {}, {}
+    key_ids = {}  # cache key: custom_id of the request sent for it
+    for request_key, (prompt, model) in requests.items():
+        keys[request_key] = ehr.cache_key(model, system, prompt, json.dumps(response_format))
+        if keys[request_key] in gpt_cache:
+            responses[request_key] = gpt_cache[keys[request_key]]
+        elif keys[request_key] in key_ids:
+            custom_ids[key_ids[keys[request_key]]].append(request_key)
+        else:
+            custom_id = "-".join(str(k) for k in request_key)
+            key_ids[keys[request_key]] = custom_id
+            custom_ids[custom_id] = [request_key]
+            log_tokens(count_system_tokens(system) + count_tokens(prompt))
+            bodies[custom_id] = {"model": model,
+                                 "messages": [{"role": "system", "content": system},
+                                              {"role": "user", "content": prompt}],
+                                 "temperature": 0,
+                                 "response_format": response_format}
+    if bodies:
+        batch_results = await ehr.run_batch(client, bodies, os.path.dirname(results_file))
+        for custom_id, text in batch_results.items():
+            for request_key in custom_ids[custom_id]:
+                responses[request_key] = text
+            if text is not None:
+                gpt_cache[keys[custom_ids[custom_id][0]]] = text
+    return responses
+
+# FUNCTION: process_all_notes_offline - Processes all notes with the Batch API (--offline)
+# Parameter: df - The pandas DataFrame containing the notes (one chunk of the input file)
+# Returns: same as process_all_notes
+# Each phase's output is the next phase's input, so in "phased" mode there is one batch per phase (6 batches for the chunk);
+# in "combined" mode one batch with a combined call per note; in "spans" mode one batch for phases 1, 2, 3, 5, and 6 and one for phase 4
+# Phases with no trigger words are skipped as in the online path
+# Long notes are split into parts (see split_note), each part is a separate request keyed by (row index, part number)
+async def process_all_notes_offline(df):
+    parts = {}
+    raw_notes = {}
+    for idx, note in zip(df.index.to_numpy(), df["note"].to_numpy()):
+        if not is_done(int(idx), note) and isinstance(note, str):
+            raw_notes[int(idx)] = note
+            note = remove_boilerplate(note)
+            if clean_mode == "spans":
+                note = remove_duplicate_sentences(note)
+            for part_no, part in enumerate(split_note(note, max_note_tokens)):
+                parts[(int(idx), part_no)] = part
+    current = dict(parts)  # latest cleaned text of each note part
+    outputs = {note_part: [] for note_part in parts}
+    failed = set()
+    if clean_mode == "phased":
+        rounds = [[phase] for phase in range(1, 7)]
+    elif clean_mode == "spans":
+        rounds = [parallel_phases, [4]]
+    else:
+        rounds = [None]
+    for round_phases in rounds:
+        requests = {}
+        for note_part, text in current.items():
+            if note_part in failed:
+                continue
+            if clean_mode == "phased":
+                phase = round_phases[0]
+                if phase_triggered(phase, text):
+                    requests[note_part] = (phase_prompts[phase - 1] + text, phase_models[phase])
+            elif clean_mode == "spans":
+                for phase in round_phases:
+                    if phase_triggered(phase, text):
+                        requests[note_part + (phase,)] = (phase_prompts[phase - 1] + text, phase_models[phase])
+            else:
+                phases = [p for p in range(1, 7) if phase_triggered(p, text)]
+                if phases:
+                    requests[note_part] = (build_combined_prompt(phases) + text, combined_model(phases))
+                else:
+                    current[note_part] = text.strip()
+        if clean_mode == "spans":
+            # Collect the text to remove from all phases of each note part, then remove it
+            spans = {}
+            for request_key, text in (await batch_gpt(requests, spans_system_content, spans_format)).items():
+                note_part = request_key[:2]
+                try:
+                    spans.setdefault(note_part, []).extend(parse_spans(text) if text is not None else [None])
+                except ValueError as e:
+                    print(f"Error at row {note_part[0]}: {e}")
+                    failed.add(note_part)
+            for note_part in current:
+                note_spans = spans.get(note_part, [])
+                if None in note_spans:
+                    failed.add(note_part)
+                elif note_part not in failed:
+                    current[note_part] = remove_spans(current[note_part], note_spans)
+        else:
+            for note_part, text in (await batch_gpt(requests)).items():
+                try:
+                    current[note_part] = parse_cleaned(text) if text is not None else None
+                except ValueError as e:
+                    print(f"Error at row {note_part[0]}: {e}")
+                    current[note_part] = None
+                if current[note_part] is None:
+                    failed.add(note_part)
+        if clean_mode != "spans" or round_phases == [4]:
+            for note_part in parts:
+                outputs[note_part].append(current[note_part])
+
+    # Join the parts of each note back together (line breaks between parts, as in clean_note)
+    note_outputs = {}
+    for (idx, part_no), part_outputs in outputs.items():
+        note_outputs.setdefault(idx, []).append(part_outputs)
+    failed_ids = {idx for idx, part_no in failed}
+
+    # Write the cleaned notes to the results file; failed notes are not written, so they are tried again on the next run
+    new_results = {}
+    with open(results_file, "a", encoding="utf-8") as f:
+        for idx, part_outputs in note_outputs.items():
+            if idx not in failed_ids:
+                new_results[idx] = write_result(f, idx, raw_notes[idx], tuple("\n".join(texts) for texts in zip(*part_outputs)))
+    return new_results
+
+# FUNCTION: clean_file - Cleans the whole input file
+# One client (and connection pool) is used for the whole run, created inside the running event loop and closed at the end
+# The tokenizer is loaded first, so a tokenizer problem stops the script instead of failing every note
+async def clean_file():
+    global client
+    ehr.get_encoding()
+    client = make_client()
+    try:
+        if not args.offline:  # --offline makes no real-time calls (a problem shows up as failed batch requests instead)
+            await dry_run()
+        await clean_chunks()
+    finally:
+        await client.close()
+
+# FUNCTION: dry_run - Sends the first note through phase 1 before the full run
+# Problems with the API key, quota, model name, or output format stop the script here, after one call
+# instead of after every note has failed (the response is not cached or saved)
+async def dry_run():
+    for note in pd.read_csv(input_file, usecols=["note"], nrows=100)["note"]:
+        if isinstance(note, str) and note.strip():
+            parse_cleaned(await request_gpt(phase_1_prompt + note, system_content, phase_models[1], cleaned_format))
+            return
+
+# FUNCTION: clean_chunks - Reads, cleans, and saves the input file one chunk at a time
+# Each chunk is fully cleaned and appended to the output Parquet and CSV files before the next chunk is read
+async def clean_chunks():
+    parquet_writer, csv_writer = None, None
+    # The results file of an earlier run: each chunk's lines are read back from it as the chunk is saved (see done_record)
+    done_file = open(results_file, "rb") if done_results else None
+    # read_csv with chunksize keeps counting the row index across chunks, so idx is the row number in the whole file
+    # Columns are read as Arrow types (no Python object per value); the note is always a string, the other columns
+    # (ids, ground truth) keep their own types, e.g. numeric ids stay numbers (nullable, so a missing value doesn't make them floats)
+    for chunk in pd.read_csv(input_file, chunksize=chunk_size, dtype={"note": pd.ArrowDtype(pa.string())}, dtype_backend="pyarrow"):
+        if args.offline:
+            new_results = await process_all_notes_offline(chunk)
+        else:
+            new_results = await process_all_notes(chunk)
+
+        # Join the cleaned notes (new, or from the results file of an earlier run) onto this chunk in one pass
+        # Notes that failed are left empty
+        records = [new_results.get(idx) or done_record(done_file, idx, note) for idx, note in zip(chunk.index, chunk["note"])]
+        for idx in chunk.index:
+            done_results.pop(idx, None)  # not needed again
+        results = pd.DataFrame([r for r in records if r is not None], columns=["idx"] + output_cols).set_index("idx")
+        chunk = chunk.join(results).astype({col: pd.ArrowDtype(pa.string()) for col in output_cols})
+
+        # Unless --debug-intermediates is set, replace the raw note with a short hash (ehr.note_hash) and drop
+        # the intermediate phase outputs, so the output files mostly hold the cleaned notes
+        # (use ehr.add_raw_notes to get the raw notes back from the input file)
+        if not args.debug_intermediates:
+            chunk.insert(chunk.columns.get_loc("note"), "note_sha",
+                         chunk["note"].map(ehr.note_hash).astype(pd.ArrowDtype(pa.string())))
+            chunk = chunk.drop(columns=["note"] + output_cols[:-1])
+
+        # Open both files with the first chunk's columns, then append each chunk to them
+        table = pa.Table.from_pandas(chunk, preserve_index=False)
+        if parquet_writer is None:
+            # A column that is empty in the first chunk has no type yet: save it as text
+            schema = pa.schema([field.with_type(pa.string()) if pa.types.is_null(field.type) else field
+                                for field in table.schema.remove_metadata()])
+            parquet_writer = pq.ParquetWriter(output_file, schema, compression="snappy")
+            csv_writer = pacsv.CSVWriter(csv_output_file, schema)
+        table = table.cast(schema)
+        parquet_writer.write_table(table)
+        csv_writer.write_table(table)
+    if parquet_writer is not None:
+        parquet_writer.close()
+        csv_writer.close()
+    if done_file is not None:
+        done_file.close()
 
 
 # ============================================================================
 # MAIN EXECUTION - Run the cleaning process
 # ============================================================================
 
+# Save the results to a new Parquet file in the data directory (compressed; read only the needed columns with
+# pd.read_parquet(output_file, columns=[...])), plus a CSV copy for the classification scripts
+output_file = os.path.join(script_dir, "../data/cleaned_output.parquet")
+csv_output_file = os.path.join(script_dir, "../data/cleaned_output.csv")
+
 # RUN THE PROCESSING
 # asyncio.run() executes the async function and waits for all notes to complete
-# max_concurrent=10 means process up to 10 notes simultaneously 
-asyncio.run(process_all_notes(df, max_concurrent=10))  
-
-# Save the results to a new CSV file in the data directory
-output_file = os.path.join(script_dir, "/data/cleaned_output.csv")
-df.to_csv(output_file, index=False)
-print(f"Results saved to: {output_file}")
+# notes are processed as fast as the OPENAI_RPM / OPENAI_TPM limits allow
+asyncio.run(clean_file())
+print(f"Results saved to: {output_file} and {csv_output_file}")
+print(f"GPT input tokens: {token_counts['input_tokens']} over {token_counts['calls']} calls (largest call: {token_counts['largest_call']})")
 
 # PERFORMANCE METRICS
-end_time = time.time()    # End timer
+end_time = time.perf_counter()    # End timer
 print(f"Script runtime: {end_time - start_time:.2f} seconds")
-mem_info = process.memory_info()
-print(f"Peak memory usage: {mem_info.rss / (1024 ** 2):.2f} MB")
\ No newline at end of file
+if args.profile:
+    _, peak_memory = tracemalloc.get_traced_memory()
+    print(f"Peak memory usage: {peak_memory / (1024 ** 2):.2f} MB")
\ No newline at end of file
@@ -6,33 +6,284 @@
 #Load Libraries
 import openai
 import re
+import json
+import hashlib
 import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyarrow.csv as pacsv
 from openai import AsyncOpenAI
 import os
-from httpx import Timeout
+import time
+import warnings
+import asyncio
+import httpx
+import diskcache
+import tiktoken
+from functools import lru_cache
+from tqdm import tqdm
+try:
+    import ahocorasick # fast multi-keyword search for the RegEx step (optional: pip install pyahocorasick)
+except ImportError:
+    ahocorasick = None
+from tenacity import retry, stop_after_attempt, wait_random_exponential, retry_if_exception_type
 
 
-client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"),
-                     timeout=Timeout(60))
+# One shared client (and connection pool) for all API calls from the analysis scripts, created by get_client() on first use,
+# so importing this file (e.g. from ehr_gpt_cleantext.py, which has its own client) doesn't open a connection pool
+client = None
 
+# FUNCTION: get_client - Returns the shared client, creating it the first time
+# HTTP/2 sends many calls over the same few connections, and up to 128 idle connections are kept open for reuse,
+# so raising max_concurrent doesn't mean a new TLS handshake for every call
+# (httpx defaults allow only 100 connections and 20 kept open; HTTP/2 needs the h2 package)
+def get_client():
+    global client
+    if client is None:
+        http_client = httpx.AsyncClient(http2=True,
+                                        limits=httpx.Limits(max_connections=256, max_keepalive_connections=128),
+                                        timeout=httpx.Timeout(60.0, connect=10.0))
+        # max_retries=0 because failed calls are retried by request_label (see below)
+        client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), http_client=http_client, max_retries=0)
+    return client
+
+# Run an async job (e.g. process_all_notes) with the shared client, then close its connections
+# The connections belong to the event loop that opened them, so they are closed before asyncio.run() ends that loop
+# (and the next run gets a new client)
+# The tokenizer is loaded first: if it can't be (e.g. no internet access to download it), the run stops here
+# instead of every note failing its token count and being labeled "Error"
+def run_with_client(job):
+    async def run_and_close():
+        global client
+        try:
+            get_encoding()
+            return await job
+        finally:
+            if client is not None:
+                await client.close()
+                client = None
+    return asyncio.run(run_and_close())
+
+
+# Labels (label, quote) already returned by the LLM, by model, instructions and note text (see label_key), saved in the
+# ../data/label_cache folder (with the other data files, as it holds note text), so a note that was labeled before
+# (in this run or an earlier one) is not sent again
+# The folder is opened on first use, so importing this file creates nothing
+@lru_cache(maxsize=None)
+def get_label_cache():
+    return diskcache.Cache(os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data", "label_cache")))
+
+
+# Request/token rate limiter for the OpenAI API (replaces a fixed number of parallel calls)
+# Keeps two buckets, requests per minute (RPM) and tokens per minute (TPM), that refill continuously
+# Each API call waits until both buckets have enough capacity before it is sent
+class RateLimiter:
+    def __init__(self, max_requests_per_minute, max_tokens_per_minute):
+        self.max_requests_per_minute = max_requests_per_minute
+        self.max_tokens_per_minute = max_tokens_per_minute
+        self.available_requests = max_requests_per_minute  # start with a full minute of capacity
+        self.available_tokens = max_tokens_per_minute
+        # Capacity added back per second (a full minute of capacity per minute, until the API reports its reset times)
+        self.requests_per_second = max_requests_per_minute / 60
+        self.tokens_per_second = max_tokens_per_minute / 60
+        self.last_update = time.monotonic()
+        self.lock = None  # created inside the running event loop (see acquire)
+        self.loop = None  # the event loop the lock belongs to
+
+    # Add back the capacity earned since the last update, up to the per-minute maximum
+    def refill(self):
+        now = time.monotonic()
+        elapsed = now - self.last_update
+        self.available_requests = min(self.max_requests_per_minute,
+                                      self.available_requests + self.requests_per_second * elapsed)
+        self.available_tokens = min(self.max_tokens_per_minute,
+                                    self.available_tokens + self.tokens_per_second * elapsed)
+        self.last_update = now
+
+    # Wait until there is capacity for 1 request using n_tokens tokens, then take it
+    async def acquire(self, n_tokens):
+        # A new lock for each event loop (e.g. each ehr.run_with_client run): an asyncio lock only works in the loop it was first used in
+        if self.lock is None or self.loop is not asyncio.get_running_loop():
+            self.lock = asyncio.Lock()
+            self.loop = asyncio.get_running_loop()
+        n_tokens = min(n_tokens, self.max_tokens_per_minute)  # a single huge call would otherwise wait forever
+        async with self.lock:  # calls are let through one at a time, in the order they arrived
+            while True:
+                self.refill()
+                if self.available_requests >= 1 and self.available_tokens >= n_tokens:
+                    self.available_requests -= 1
+                    self.available_tokens -= n_tokens
+                    return
+                await asyncio.sleep(0.1)
+
+    # Follow the rate limits reported by the API in each response's headers, so OPENAI_RPM / OPENAI_TPM are only used
+    # until the first response (e.g. a higher tier account is not held to the tier 1 defaults):
+    #   - x-ratelimit-limit-*: the account's requests/tokens per minute, the most each bucket holds
+    #   - x-ratelimit-remaining-*: what the account has left right now (e.g. other jobs using the same key), the bucket never holds more
+    #   - x-ratelimit-reset-*: time until the account is back to its full limit, the bucket refills at the same pace
+    def update_from_headers(self, headers):
+        self.refill()
+        self.max_requests_per_minute, self.available_requests, self.requests_per_second = header_bucket(
+            headers, "requests", self.max_requests_per_minute, self.available_requests, self.requests_per_second)
+        self.max_tokens_per_minute, self.available_tokens, self.tokens_per_second = header_bucket(
+            headers, "tokens", self.max_tokens_per_minute, self.available_tokens, self.tokens_per_second)
+
+# One RateLimiter bucket ("requests" or "tokens") updated from the x-ratelimit-* headers (see RateLimiter.update_from_headers)
+# Returns the new (capacity, available, refill per second); a header that is missing keeps the current value
+def header_bucket(headers, name, capacity, available, per_second):
+    limit = headers.get(f"x-ratelimit-limit-{name}")
+    remaining = headers.get(f"x-ratelimit-remaining-{name}")
+    reset = headers.get(f"x-ratelimit-reset-{name}")
+    if limit is not None:
+        capacity = float(limit)
+        per_second = capacity / 60
+    if remaining is not None:
+        available = min(available, float(remaining))
+        reset = reset_seconds(reset) if reset is not None else 0
+        if reset > 0 and float(remaining) < capacity:
+            per_second = (capacity - float(remaining)) / reset
+    return capacity, min(available, capacity), per_second
+
+# Seconds in an x-ratelimit-reset-* header, e.g. "1s", "6m0s", "20ms", "1h2m3.5s"
+def reset_seconds(value):
+    units = {"h": 3600, "m": 60, "s": 1, "ms": 0.001}
+    return sum(float(amount) * units[unit] for amount, unit in re.findall(r"([\d.]+)(ms|h|m|s)", value))
+
+
+# Number of API calls allowed at once for the analysis scripts, adjusted while they run (see request_label)
+# After each response the limit is set from the account's rate limits (x-ratelimit-limit-requests / x-ratelimit-limit-tokens headers)
+# and the measured time per call: calls allowed per second (by requests per minute, and by tokens per minute / tokens per call)
+# times the average seconds a call takes is how many calls need to be running at once to use the limits, between 1 and max_concurrent
+# After a rate limit error (429) the limit is halved
+class AdaptiveConcurrency:
+    def __init__(self, start, max_concurrent):
+        self.limit = start
+        self.max_concurrent = max_concurrent
+        self.running = 0
+        self.latency = None  # average seconds per call (moving average, see record_latency)
+
+    # Wait until fewer than limit calls are running, then count this one
+    async def acquire(self):
+        while self.running >= self.limit:
+            await asyncio.sleep(0.1)
+        self.running += 1
+
+    def release(self):
+        self.running -= 1
+
+    def set_limit(self, limit):
+        limit = max(1, min(self.max_concurrent, int(limit)))
+        if limit != self.limit:
+            print(f"API calls at once: {self.limit} -> {limit}")
+            self.limit = limit
+
+    def record_latency(self, seconds):
+        self.latency = seconds if self.latency is None else 0.8 * self.latency + 0.2 * seconds
+
+    # call_tokens: the tokens of the call that returned these headers (as counted for label_rate_limiter)
+    def update_from_headers(self, headers, call_tokens):
+        limit_requests = headers.get("x-ratelimit-limit-requests")
+        limit_tokens = headers.get("x-ratelimit-limit-tokens")
+        if limit_requests is None or limit_tokens is None or self.latency is None:
+            return
+        calls_per_minute = min(float(limit_requests), float(limit_tokens) / max(call_tokens, 1))
+        self.set_limit(calls_per_minute / 60 * self.latency)
+
+    def rate_limited(self):
+        self.set_limit(self.limit // 2)
+
+# Most API calls at once (and workers started by the analysis scripts), from the EHR_MAX_CONCURRENT setting (default 50)
+max_concurrent = int(os.getenv("EHR_MAX_CONCURRENT", "50"))
+
+# Starts at 10 calls at once (the old fixed setting) and can go up to max_concurrent
+label_concurrency = AdaptiveConcurrency(start=min(10, max_concurrent), max_concurrent=max_concurrent)
+
+# Requests/tokens per minute for the analysis scripts' API calls, from the same OPENAI_RPM / OPENAI_TPM settings as ehr_gpt_cleantext.py
+# (defaults are the lowest, tier 1, limits for GPT-4o) until the first response reports the account's own limits (see RateLimiter.update_from_headers);
+# each call waits for room under both limits (see request_label)
+label_rate_limiter = RateLimiter(max_requests_per_minute=int(os.getenv("OPENAI_RPM", "500")),
+                                 max_tokens_per_minute=int(os.getenv("OPENAI_TPM", "30000")))
+
+# Input tokens of a call, counted before it is sent (same tokenizer as gpt-4o and gpt-4o-mini)
+# The tokenizer is loaded on first use (tiktoken downloads it the first time), so importing this file needs no internet access
+@lru_cache(maxsize=None)
+def get_encoding():
+    return tiktoken.encoding_for_model("gpt-4o")
+
+def count_tokens(text):
+    return len(get_encoding().encode(text, disallowed_special=()))
+
+# The instructions are the same for every call, so they are only counted once
+@lru_cache(maxsize=None)
+def count_prompt_tokens(prompt_text):
+    return count_tokens(prompt_text)
+
+
+# The task instructions (prompt_text) are sent as their own first message, identical for every note, and the note(s) in a second message
+# OpenAI caches a repeated prompt start of 1024+ tokens, so after the first call the instructions are mostly served from the cache
+# (cheaper and faster); prompt_cache_key (a hash of the instructions) sends calls with the same instructions to the same cache
+def label_messages(prompt_text, user_content):
+    return [{"role": "system", "content": prompt_text},
+            {"role": "user", "content": user_content}]
+
+def prompt_cache_key(prompt_text):
+    return hashlib.sha256(prompt_text.encode("utf-8")).hexdigest()[:16]
+
+# Cap on the LLM's answer length, per answer line ("Yes | brief quote" or "No"): a call answering several notes (or tasks)
+# gets answer_tokens for each; stops a rambling answer early (less waiting, fewer output tokens paid for and counted against the TPM limit)
+answer_tokens = 64
+
+# Make a single API call for analyze_symptom_parallel / analyze_symptoms_batch
+# Calls that fail from rate limits, connection problems, timeouts, or OpenAI server errors are retried up to 6 times,
+# waiting a random, exponentially growing time (up to 30 seconds) between attempts, so a short outage doesn't label notes "Error"
+# Other errors (e.g. a bad API key) are not retried
+@retry(wait=wait_random_exponential(min=1, max=30), stop=stop_after_attempt(6), reraise=True,
+       retry=retry_if_exception_type((openai.RateLimitError, openai.APIConnectionError,
+                                      openai.APITimeoutError, openai.InternalServerError)))
+# n_answers: number of answer lines expected (notes x tasks), for the answer length cap (answer_tokens)
+async def request_label(prompt_text, user_content, model="gpt-4o", n_answers=1):
+    # Wait until another call is allowed (label_concurrency) and there is room under the RPM/TPM limits (label_rate_limiter),
+    # and adjust both from the response's rate limit headers
+    # Token estimate: input tokens, plus the longest answer allowed
+    max_tokens = answer_tokens * n_answers
+    call_tokens = count_prompt_tokens(prompt_text) + count_tokens(user_content) + max_tokens
+    await label_concurrency.acquire()
+    try:
+        await label_rate_limiter.acquire(call_tokens)
+        start = time.monotonic()
+        # with_raw_response gives access to the rate limit headers, .parse() returns the usual response
+        raw_response = await get_client().chat.completions.with_raw_response.create(
+            #model="gpt-3.5-turbo",
+            model=model,
+            messages=label_messages(prompt_text, user_content),
+            temperature=0,
+            max_tokens=max_tokens,
+            prompt_cache_key=prompt_cache_key(prompt_text),
+        )
+    except openai.RateLimitError:
+        label_concurrency.rate_limited()
+        raise
+    finally:
+        label_concurrency.release()
+    label_concurrency.record_latency(time.monotonic() - start)
+    label_concurrency.update_from_headers(raw_response.headers, call_tokens)
+    label_rate_limiter.update_from_headers(raw_response.headers)
+    return raw_response.parse()
 
 # PARALLELIZED -- Analyze an EHR note using the language model and return a label and supporting quote
 async def analyze_symptom_parallel(ehr_text, prompt_text):
     if pd.isna(ehr_text) or not str(ehr_text).strip():
         return "No", ""  # Return "No" if the note is empty or missing
 
-    # Construct the prompt for the LLM
-    prompt = prompt_text + f"\n\"\"\"{ehr_text}\"\"\"\n"
+    key = label_key(prompt_text, ehr_text)
+    if key in get_label_cache():
+        return get_label_cache()[key]
+
+    # Construct the prompt for the LLM (the note goes in its own message after prompt_text)
+    prompt = f"\"\"\"{ehr_text}\"\"\"\n"
     try:
-        response = await client.chat.completions.create(
-            #model="gpt-3.5-turbo",
-            model="gpt-4o",
-            messages=[
-                #{"role": "system", "content": system_content},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0,
-        )
+        response = await request_label(prompt_text, prompt)
 
         # Clean and parse the LLM's output
         raw_output = response.choices[0].message.content.strip()
@@ -45,6 +296,7 @@ async def analyze_symptom_parallel(ehr_text, prompt_text):
             label = cleaned.strip()
             quote = ""
 
+        get_label_cache()[key] = (label, quote)
         return label, quote
 
     except Exception as e:
@@ -52,6 +304,265 @@ async def analyze_symptom_parallel(ehr_text, prompt_text):
         return "Error", ""  # Return error label if something goes wrong
 
 
+# Model to use for each note: model, or regex_hit_model for the notes the RegEx search already flagged (regex_yesno == "Yes")
+# A model of None means the note is not sent to the LLM and gets its label from the RegEx search (see fill_regex_labels):
+# regex_hit_model None labels the RegEx hits "Yes" (the match as the supporting quote), model None labels the misses "No"
+def note_models(regex_yesno, regex_hit_model, model="gpt-4o"):
+    return [regex_hit_model if yesno == "Yes" else model for yesno in regex_yesno]
+
+# Optional prefilter before the LLM, so only the notes the RegEx search can't decide on its own are sent (both off by default):
+#   - vocab_pattern: notes without a RegEx hit are only sent if they match it (words about the topic);
+#     the others get their label from the RegEx search ("No", see fill_regex_labels)
+#   - denial_pattern: notes with a RegEx hit that also match it (e.g. a denial near the keyword) are always sent,
+#     with model, even when regex_hit_model is None
+# notes are the raw notes the RegEx search ran on; returns the models with these changes (see note_models)
+# True for each note in which the pattern is found
+def contains_pattern(notes, pattern):
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", UserWarning)  # pandas warns about the (...) group that only groups the keywords
+        return notes.str.contains(compile_pattern(pattern)).to_numpy(dtype=bool)
+
+def prefilter_models(notes, regex_yesno, models, vocab_pattern=None, denial_pattern=None, model="gpt-4o"):
+    hit = np.asarray(regex_yesno) == "Yes"
+    notes = notes.fillna("").astype(str)
+    models = list(models)
+    if vocab_pattern is not None:
+        vocab = contains_pattern(notes, vocab_pattern)
+        models = [None if not is_hit and not has_vocab else note_model for note_model, is_hit, has_vocab in zip(models, hit, vocab)]
+    if denial_pattern is not None:
+        denial = contains_pattern(notes, denial_pattern)
+        models = [model if is_hit and has_denial and note_model is None else note_model
+                  for note_model, is_hit, has_denial in zip(models, hit, denial)]
+    n_skipped = sum(note_model is None for note_model in models)
+    print(f"Prefilter: {n_skipped} of {len(models)} notes labeled from the RegEx search only")
+    return models
+
+# Empty or missing notes get the label "No" right away and are not sent to the LLM
+# The check is done for the whole column at once, instead of note by note inside the API call functions
+# Returns the models with None for the empty notes (as in note_models)
+def skip_empty_notes(df, notes, models):
+    empty = (notes.isna() | (notes.astype(str).str.strip() == "")).to_numpy()
+    df.loc[empty, "Label"] = "No"
+    return [None if is_empty else model for model, is_empty in zip(models, empty)]
+
+# Partial results file: each LLM label is appended (one JSON line per note) as soon as it is done, so a stopped run loses nothing
+# Each line has the note's row index and its label_key (model, instructions and note text)
+# load_partial fills in the labels already in the file and returns their row indexes, so those notes are not sent again
+# keys: {row index: label_key} for this run; a line whose key doesn't match (the input file was changed or reordered,
+# or the prompt or model was edited since) is not used, so the note is labeled again
+def load_partial(df, partial_file, keys):
+    records = {record["idx"]: record for record in read_jsonl(partial_file)
+               if record["idx"] in keys and record.get("key") == keys[record["idx"]]}  # the last line per note counts
+    done = set(records)
+    if done:
+        # all loaded labels written to the columns at once
+        df.loc[list(records), "Label"] = [record["label"] for record in records.values()]
+        df.loc[list(records), "Supporting_Quote"] = [record["quote"] for record in records.values()]
+        print(f"Resuming: {len(done)} notes already labeled in {partial_file}")
+    return done
+
+# Append one label to the partial results file; failed notes (None or "Error") are not written, so they are tried again next run
+def write_partial(f, idx, label, quote, key):
+    if label is None or label == "Error":
+        return
+    f.write(json.dumps({"idx": int(idx), "key": key, "label": label, "quote": quote}) + "\n")
+    f.flush()  # make sure the line is on disk before moving on
+
+# Cache key for a note's label: the model, the instructions, and the note text
+def label_key(prompt_text, note, model="gpt-4o"):
+    return cache_key(model, prompt_text, str(note))
+
+# Save labels just returned by the LLM in label_cache (failed notes, "Error", are not saved so they are tried again)
+def cache_labels(notes, prompt_text, model, outputs):
+    for note, (label, quote) in zip(notes, outputs):
+        if label is not None and label != "Error" and not pd.isna(note) and str(note).strip():
+            get_label_cache()[label_key(prompt_text, note, model)] = (label, quote)
+
+# Before sending notes to the LLM: notes labeled before (in label_cache) get their saved label right away,
+# and identical notes (same text and model) are sent only once
+# Returns the models to send the notes with (None for notes not sent, as in note_models)
+# and {row index of each sent note: [row indexes of the identical notes that get its label]} (see set_label)
+def dedupe_notes(df, notes, models, prompt_text):
+    label_cache = get_label_cache()
+    send_models = list(models)
+    first_idx = {}
+    copies = {}
+    cached = {}
+    for i, (idx, note, model) in enumerate(zip(df.index, notes, models)):
+        if model is None or pd.isna(note) or not str(note).strip():
+            continue  # not sent, or empty (labeled "No" without an API call)
+        key = label_key(prompt_text, note, model)
+        if key in label_cache:
+            cached[idx] = label_cache[key]
+            send_models[i] = None
+        elif key in first_idx:
+            copies[first_idx[key]].append(idx)
+            send_models[i] = None
+        else:
+            first_idx[key] = idx
+            copies[idx] = []
+    if cached:
+        # all saved labels written to the columns at once
+        df.loc[list(cached), "Label"] = [label for label, _ in cached.values()]
+        df.loc[list(cached), "Supporting_Quote"] = [quote for _, quote in cached.values()]
+    n_sent = sum(model is not None for model in send_models)
+    n_models = sum(model is not None for model in models)
+    if n_sent < n_models:
+        print(f"Sending {n_sent} of {n_models} notes to the LLM (the rest were labeled before or are identical to another note)")
+    return send_models, copies
+
+# Labels collected while the LLM calls run, kept in plain lists by row position (one list item set per label, no DataFrame lookups)
+# and written to df's Label and Supporting_Quote columns in one go when all notes are done (write_to)
+# keys: {row index: label_key}, saved with each label in the partial results file (see load_partial)
+class Labels:
+    def __init__(self, df, keys):
+        self.position = {idx: pos for pos, idx in enumerate(df.index)}
+        self.labels = df["Label"].tolist()
+        self.quotes = df["Supporting_Quote"].tolist()
+        self.keys = keys
+
+    def set(self, idx, label, quote):
+        self.labels[self.position[idx]] = label
+        self.quotes[self.position[idx]] = quote
+
+    def write_to(self, df):
+        df["Label"] = self.labels
+        df["Supporting_Quote"] = self.quotes
+
+# Store a note's label (in labels, see Labels) and in the partial results file, and the same label for its identical notes
+# (copies, see dedupe_notes)
+def set_label(labels, f, idx, label, quote, copies):
+    for i in [idx] + copies.get(idx, []):
+        labels.set(i, label, quote)
+        write_partial(f, i, label, quote, labels.keys[i])
+
+# Save the results as CSV and as a zstd-compressed Parquet file next to it (smaller, faster to load),
+# and the metrics from calcstats as a small CSV next to them (<output>_metrics.csv)
+# Both result files are written by pyarrow from one Arrow table (multithreaded, faster than pandas to_csv)
+# Text columns are saved as strings (a column with some missing values would otherwise mix types)
+def save_output(df, metrics, output_file):
+    text_cols = {col: "string" for col in df.columns if df[col].dtype == object}
+    table = pa.Table.from_pandas(df.astype(text_cols), preserve_index=False)
+    pq.write_table(table, os.path.splitext(output_file)[0] + ".parquet", compression="zstd")
+    # Categorical columns are written to the CSV as their text
+    pacsv.write_csv(pa.table([col.cast(col.type.value_type) if pa.types.is_dictionary(col.type) else col for col in table.columns],
+                             names=table.column_names), output_file)
+    metrics.to_csv(os.path.splitext(output_file)[0] + "_metrics.csv")
+
+# Label the notes that were not sent to the LLM (model None in note_models / prefilter_models) from the RegEx search:
+# Label "Yes" and the RegEx match as the supporting quote for RegEx hits, "No" for the others
+def fill_regex_labels(df, models):
+    skipped = np.array([model is None for model in models], dtype=bool)
+    df.loc[skipped, "Label"] = df.loc[skipped, "Regex"].astype(str)
+    df.loc[skipped, "Supporting_Quote"] = df.loc[skipped, "Regex_match"]
+    return df
+
+# Split notes into groups for analyze_symptoms_batch: at most batch_size notes and about max_chars characters of note text per group
+# (a single note longer than max_chars is sent in a group by itself)
+# models (optional, see note_models): notes for different models go in different groups, notes with model None are left out
+# Returns a list of (row indexes, notes, model) groups
+def group_notes(idxs, notes, batch_size=20, max_chars=100000, models=None):
+    if models is None:
+        models = ["gpt-4o"] * len(notes)
+    groups = []
+    for group_model in dict.fromkeys(model for model in models if model is not None):
+        group_idxs, group_notes, group_chars = [], [], 0
+        for idx, note, model in zip(idxs, notes, models):
+            if model != group_model:
+                continue
+            n_chars = len(note) if isinstance(note, str) else 0
+            if group_notes and (len(group_notes) == batch_size or group_chars + n_chars > max_chars):
+                groups.append((group_idxs, group_notes, group_model))
+                group_idxs, group_notes, group_chars = [], [], 0
+            group_idxs.append(idx)
+            group_notes.append(note)
+            group_chars += n_chars
+        if group_notes:
+            groups.append((group_idxs, group_notes, group_model))
+    return groups
+
+# Analyze several EHR notes in one API call, return a list of (label, supporting quote), one per note
+# The notes are numbered in the prompt and the LLM answers with one numbered line per note,
+# so the prompt instructions are only sent (and paid for) once per group instead of once per note
+# Empty or missing notes are not sent ("No"); notes missing from the LLM's answer get "Error"
+async def analyze_symptoms_batch(notes, prompt_text, model="gpt-4o"):
+    results = [("No", "") if pd.isna(note) or not str(note).strip() else ("Error", "") for note in notes]
+    numbers = [i for i, note in enumerate(notes, start=1) if results[i - 1][0] == "Error"]
+    if not numbers:
+        return results
+
+    # Construct the prompt for the LLM: each note with its number (the instructions are sent first, in their own message)
+    prompt = "\n".join(f'### NOTE {i}\n"""{notes[i - 1]}"""' for i in numbers)
+    prompt += (f"\n\nAnswer for each of the {len(numbers)} notes above separately. Output exactly {len(numbers)} lines, one per note, "
+               f"starting with the note number, in the format: i: Yes | [brief supporting quote from the note]  or  i: No")
+    try:
+        response = await request_label(prompt_text, prompt, model, n_answers=len(numbers))
+
+        # Clean and parse the LLM's output, one "i: label | quote" line per note
+        raw_output = response.choices[0].message.content.strip()
+        lines = [line for line in re.sub(r"[\*\`]", "", raw_output).splitlines() if line.strip()]
+        for line in lines:
+            match = re.match(r"\s*(?:-\s*)?(?:NOTE\s*)?(\d+)\s*[:.)]\s*(.*)", line, re.IGNORECASE)
+            if not match or int(match.group(1)) not in numbers:
+                continue
+            results[int(match.group(1)) - 1] = parse_label(match.group(2))
+        # With a single note, the LLM may answer in the task prompt's own format ("Yes | quote" or "No") without the note number,
+        # or number it 1 when it was another note number: its first line is that note's answer
+        if len(numbers) == 1 and results[numbers[0] - 1][0] == "Error" and lines:
+            results[numbers[0] - 1] = parse_label(re.sub(r"^\s*(?:-\s*)?(?:NOTE\s*)?\d+\s*[:.)]\s*", "", lines[0], flags=re.IGNORECASE))
+        cache_labels(notes, prompt_text, model, results)
+        return results
+
+    except Exception as e:
+        print(f"Error processing notes: {e}")
+        return results  # Return error labels if something goes wrong
+
+# Analyze many EHR notes through the OpenAI Batch API (~50% cheaper, results within 24 hours), return a list of (label, supporting quote)
+# One request per note, with the same prompt as analyze_symptom_parallel, on gpt-4o or the note's model from models (see note_models)
+# Empty or missing notes are not sent ("No"); notes whose request failed get "Error"; notes with model None are not sent (fill_regex_labels)
+# parse (optional): how to read each answer instead of parse_label (e.g. run_tasks_fused); those answers are not saved in label_cache
+# n_answers: number of answer lines per note (one per task for run_tasks_fused), for the answer length cap (answer_tokens)
+async def analyze_symptoms_offline(notes, prompt_text, batch_dir, models=None, batch_name="batch_input", parse=None, n_answers=1):
+    if models is None:
+        models = ["gpt-4o"] * len(notes)
+    results = [("No", "") if pd.isna(note) or not str(note).strip() else ("Error", "") for note in notes]
+    # Identical notes (same text and model, see label_key) are sent once: {custom_id: positions of the notes that get its answer}
+    requests, copies, first_id = {}, {}, {}
+    for i, note in enumerate(notes):
+        if results[i][0] != "Error" or models[i] is None:
+            continue
+        key = label_key(prompt_text, note, models[i])
+        if key in first_id:
+            copies[first_id[key]].append(i)
+            continue
+        first_id[key] = str(i)
+        copies[str(i)] = [i]
+        requests[str(i)] = {"model": models[i],
+                            "messages": label_messages(prompt_text, f"\"\"\"{note}\"\"\"\n"),
+                            "temperature": 0,
+                            "max_tokens": answer_tokens * n_answers,
+                            "prompt_cache_key": prompt_cache_key(prompt_text)}
+    if requests:
+        for custom_id, raw_output in (await run_batch(get_client(), requests, batch_dir, batch_name=batch_name)).items():
+            if raw_output is not None:
+                output = (parse or parse_label)(raw_output)
+                for i in copies[custom_id]:
+                    results[i] = output
+                if parse is None:
+                    cache_labels([notes[int(custom_id)]], prompt_text, models[int(custom_id)], [results[int(custom_id)]])
+    return results
+
+# Clean and parse the LLM's output into label and quote ("Yes | quote" or "No")
+def parse_label(raw_output):
+    cleaned = re.sub(r"[\*\`]", "", raw_output.strip())
+    # Split output into label and quote if "|" is present
+    if "|" in cleaned:
+        label, quote = map(str.strip, cleaned.split("|", 1))
+    else:
+        label = cleaned.strip()
+        quote = ""
+    return label, quote
+
 # (not parallelized version) Analyze a single EHR note using the language model and return a label and supporting quote
 def analyze_symptom(ehr_text, prompt_text):
     if pd.isna(ehr_text) or not str(ehr_text).strip():
@@ -86,11 +597,134 @@ def analyze_symptom(ehr_text, prompt_text):
         print(f"Error processing note: {e}")
         return "Error", ""  # Return error label if something goes wrong
 
+# Cache key for an API call: hash of everything that determines the response (model, instructions, prompt + note)
+def cache_key(*parts):
+    return hashlib.sha256("\x1f".join(parts).encode("utf-8")).hexdigest()
+
+# Calls currently waiting on the API, by cache key (see cached_call)
+in_flight = {}
+
+# Return the saved response if this exact call was made before (in this run or an earlier one),
+# otherwise make the call once with make_call() and save the response in the cache
+# cache is any dict-like store, e.g. a diskcache.Cache that persists between runs
+# Identical calls running at the same time share one request instead of each calling the API
+async def cached_call(cache, key, make_call):
+    if key in cache:
+        return cache[key]
+    if key not in in_flight:
+        in_flight[key] = asyncio.ensure_future(make_call())
+    task = in_flight[key]
+    try:
+        result = await task
+    finally:
+        in_flight.pop(key, None)
+    cache[key] = result
+    return result
+
+# Run chat completion requests through the OpenAI Batch API (for offline runs: ~50% cheaper, no RPM limit, results within 24h)
+# Parameters:
+#   - client: an AsyncOpenAI client
+#   - requests: dict of {custom_id: request body}, where the body has the same arguments as client.chat.completions.create
+#   - batch_dir: folder to write the batch input file(s) to
+#   - poll_seconds: how often to check if the batch has finished
+#   - batch_name: start of the batch input file names (<batch_name>_0.jsonl, ...), so runs at the same time don't overwrite each other's files
+# Returns: dict of {custom_id: response text}, with None for requests that failed
+# Requests are split into batches of at most max_batch_requests (the API allows up to 50,000 per batch)
+# The batch input files (which hold the full notes) are deleted once every batch has completed;
+# they are kept if a batch failed, expired, or was cancelled
+async def run_batch(client, requests, batch_dir, poll_seconds=60, max_batch_requests=50000, batch_name="batch_input"):
+    custom_ids = list(requests)
+    batch_ids, batch_files = [], []
+    # Write each batch input JSONL file, upload it, and start the batch
+    for start in range(0, len(custom_ids), max_batch_requests):
+        batch_file = os.path.join(batch_dir, f"{batch_name}_{start // max_batch_requests}.jsonl")
+        batch_files.append(batch_file)
+        with open(batch_file, "w", encoding="utf-8") as f:
+            for custom_id in custom_ids[start:start + max_batch_requests]:
+                f.write(json.dumps({"custom_id": custom_id, "method": "POST", "url": "/v1/chat/completions",
+                                    "body": requests[custom_id]}) + "\n")
+        with open(batch_file, "rb") as f:
+            uploaded = await client.files.create(file=f, purpose="batch")
+        batch = await client.batches.create(input_file_id=uploaded.id, endpoint="/v1/chat/completions",
+                                            completion_window="24h")
+        print(f"Submitted batch {batch.id} ({min(max_batch_requests, len(custom_ids) - start)} requests)")
+        batch_ids.append(batch.id)
+
+    # Wait for each batch to finish, then download and parse its results
+    results = {custom_id: None for custom_id in custom_ids}
+    all_completed = True
+    for batch_id in batch_ids:
+        batch = await client.batches.retrieve(batch_id)
+        while batch.status not in ("completed", "failed", "expired", "cancelled"):
+            await asyncio.sleep(poll_seconds)
+            batch = await client.batches.retrieve(batch_id)
+        print(f"Batch {batch_id} {batch.status}")
+        all_completed = all_completed and batch.status == "completed"
+        if not batch.output_file_id:
+            continue
+        output = await client.files.content(batch.output_file_id)
+        for line in output.text.splitlines():
+            record = json.loads(line)
+            response = record.get("response") or {}
+            if response.get("status_code") == 200:
+                results[record["custom_id"]] = response["body"]["choices"][0]["message"]["content"].strip()
+            else:
+                print(f"Error processing request {record['custom_id']}: {record.get('error') or response.get('body')}")
+    if all_completed:
+        for batch_file in batch_files:
+            os.remove(batch_file)
+    return results
+
+# Read an append-only JSONL results file (one JSON record per line) written while a script runs
+# Returns a list of records; a missing file gives an empty list and a partly written last line
+# (e.g. if the script was killed mid-write) is skipped so that note is simply processed again
+def read_jsonl(path):
+    records = []
+    if not os.path.exists(path):
+        return records
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue
+    return records
+
+# Check the input file before any API calls are made, so a wrong path or column name stops the script right away
+# instead of after the notes have been sent to GPT
+# Only the header line is read
+def check_input(input_file, columns):
+    if not os.path.exists(input_file):
+        raise FileNotFoundError(f"Input file not found: {input_file}")
+    missing = [col for col in columns if col not in pd.read_csv(input_file, nrows=0).columns]
+    if missing:
+        raise ValueError(f"Input file {input_file} is missing column(s): {', '.join(missing)}")
+
+# Short fingerprint of a raw note, saved in the cleaning output in place of the full note text (see ehr_gpt_cleantext.py)
+def note_hash(note):
+    if not isinstance(note, str):
+        return None
+    return hashlib.sha256(note.encode("utf-8")).hexdigest()[:16]
+
+# Add the raw note text back to the cleaning output by matching note_sha against the notes in the cleaning input file
+# Needed for the RegEx search, which runs on the raw note
+def add_raw_notes(df, input_file):
+    check_input(input_file, ["note"])
+    notes = pd.read_csv(input_file, usecols=["note"], engine="pyarrow", dtype_backend="pyarrow")["note"].dropna().drop_duplicates()
+    raw_notes = dict(zip(notes.map(note_hash), notes))
+    df.insert(df.columns.get_loc("note_sha"), "note", df["note_sha"].map(raw_notes))
+    return df
+
+# Regex patterns can be given compiled (re.compile(..., re.IGNORECASE), as in the analysis scripts) or as a string
+# A string is compiled case-insensitive
+def compile_pattern(pattern):
+    return pattern if hasattr(pattern, "findall") else re.compile(pattern, re.IGNORECASE)
+
 # Search for keywords/phrases in the note using regex
 def search_regex(ehr_text, pattern):
     if pd.isna(ehr_text) or not str(ehr_text).strip():
         return "No", ""
-    matches = re.findall(pattern, str(ehr_text), re.IGNORECASE)
+    matches = compile_pattern(pattern).findall(str(ehr_text))
     if matches:
         # Remove duplicates, preserve lowercase as found
         matched_str = ", ".join(sorted(set([m.lower() for m in matches])))
@@ -98,6 +732,85 @@ def search_regex(ehr_text, pattern):
     else:
         return "No", ""
 
+# Keyword search with the same matches as pattern.findall, for case-insensitive patterns of the form \b(keyword1|keyword2|...)\b or \b(?:keyword1|...)\b
+# (as in the analysis scripts)
+# The plain keywords are found with one Aho-Corasick automaton, a single pass over the note however many keywords there are;
+# the few keywords that are regex themselves (e.g. non[-\s]?binary) are searched with their own small regex
+# As with the regex, at each position the first keyword (in pattern order) that matches is used, and the search continues after it
+class KeywordMatcher:
+    def __init__(self, keywords):
+        self.automaton = ahocorasick.Automaton()
+        self.regex_orders = []  # place in the pattern of each regex keyword
+        regex_keywords = []
+        for order, keyword in enumerate(keywords):
+            if re.search(r"[\\.^$*+?{}\[\]|()]", keyword):
+                self.regex_orders.append(order)
+                regex_keywords.append(r"\b(" + keyword + r")\b")
+            elif keyword.lower() not in self.automaton:  # a repeated keyword keeps its first place in the order
+                self.automaton.add_word(keyword.lower(), (order, len(keyword.lower())))
+        self.automaton.make_automaton()
+        # One regex for all the regex keywords; as a lookahead it finds every place one matches, even inside another keyword's match
+        # (at each place, the group that matched is the first regex keyword in pattern order)
+        self.regex = re.compile("(?=" + "|".join(regex_keywords) + ")", re.IGNORECASE) if regex_keywords else None
+        # The keyword list as one regex, for notes the automaton can't search (see findall)
+        self.pattern = re.compile(r"\b(?:" + "|".join(keywords) + r")\b", re.IGNORECASE)
+
+    # Return a KeywordMatcher for pattern, or None if the pattern is not a case-insensitive keyword list (or pyahocorasick is missing)
+    @staticmethod
+    def from_pattern(pattern):
+        keywords = re.fullmatch(r"\\b\((?:\?:)?(.*)\)\\b", pattern.pattern)
+        if ahocorasick is None or not pattern.flags & re.IGNORECASE or keywords is None or "(" in keywords.group(1):
+            return None
+        return KeywordMatcher(keywords.group(1).split("|"))
+
+    # Word boundary (\b) at position i of text: a word character on one side only
+    @staticmethod
+    def boundary(text, i):
+        before = i > 0 and (text[i - 1].isalnum() or text[i - 1] == "_")
+        after = i < len(text) and (text[i].isalnum() or text[i] == "_")
+        return before != after
+
+    def findall(self, text):
+        # A few characters change length when lowercased (e.g. "İ"); positions in the lowercased note would then not
+        # line up with the note, so those notes are searched with the regex
+        if len(text.lower()) != len(text):
+            return self.pattern.findall(text)
+        text = text.lower()
+        # candidates: {start position: [(keyword order, end position), ...]} for every keyword match with word boundaries at both ends
+        candidates = {}
+        if len(self.automaton):
+            for end, (order, length) in self.automaton.iter(text):
+                start = end - length + 1
+                if self.boundary(text, start) and self.boundary(text, end + 1):
+                    candidates.setdefault(start, []).append((order, end + 1))
+        if self.regex is not None:
+            for match in self.regex.finditer(text):
+                candidates.setdefault(match.start(), []).append((self.regex_orders[match.lastindex - 1], match.end(match.lastindex)))
+        # Leftmost match first, the first keyword in pattern order at that position, no overlapping matches (as re.findall)
+        matches, pos = [], 0
+        for start in sorted(candidates):
+            if start >= pos:
+                order, end = min(candidates[start])
+                matches.append(text[start:end])
+                pos = end
+        return matches
+
+# Search for keywords/phrases in all notes at once (same result as search_regex on each note)
+# The pattern is compiled once and run over the whole column, instead of a Python loop over the rows
+# Keyword lists are searched with KeywordMatcher (Aho-Corasick) when pyahocorasick is installed
+# Returns two Series: "Yes"/"No" and the matched string(s)
+def search_regex_all(notes, pattern):
+    pattern = compile_pattern(pattern)
+    matcher = KeywordMatcher.from_pattern(pattern)
+    if matcher is not None:
+        matches = notes.fillna("").astype(str).map(matcher.findall)
+    else:
+        matches = notes.fillna("").astype(str).str.findall(pattern)
+    # Remove duplicates, preserve lowercase as found
+    matched_str = matches.map(lambda found: ", ".join(sorted(set(m.lower() for m in found))))
+    yesno = matches.map(lambda found: "Yes" if found else "No").astype(yesno_type)
+    return yesno, matched_str
+
 # Compare ground truth and predicted label, return classification type
 def label_type(val1, val2):
     # TP = True Positive, FN = False Negative, FP = False Positive, TN = True Negative
@@ -125,64 +838,275 @@ def label_type_ei(val1, val2, val3):
     else:
         return 'ERROR'   # In case it doesn't fit any
 
-# Initialize DataFrame columns and set up metric labels
+# First letter ("Y", "N", ...) of each value in a column, after stripping spaces; empty for missing or non-text values
+def first_letter(values):
+    return pd.Series(values).str.strip().str[:1].fillna("").to_numpy()
+
+# Whole-column versions of label_type / label_type_ei: same results, computed for all rows at once instead of row by row
+# (a missing or non-text value gives 'ERROR' instead of stopping the script)
+# Returned as a categorical column (outcome_type, see setupdf)
+def label_type_vec(truth, pred):
+    truth, pred = first_letter(truth), first_letter(pred)
+    return pd.Categorical(np.select([(truth == "Y") & (pred == "Y"), (truth == "Y") & (pred == "N"),
+                                     (truth == "N") & (pred == "Y"), (truth == "N") & (pred == "N")],
+                                    ["TP", "FN", "FP", "TN"], default="ERROR"), dtype=outcome_type)
+
+def label_type_ei_vec(truth, pred1, pred2):
+    pred1, pred2 = first_letter(pred1), first_letter(pred2)
+    # Either/or prediction: "Y" if either is Yes, "N" if both are No, otherwise neither (ERROR)
+    either = np.select([(pred1 == "Y") | (pred2 == "Y"), (pred1 == "N") & (pred2 == "N")], ["Y", "N"], default="")
+    return label_type_vec(truth, either)
+
+# Column types for the result columns: categorical, so each value is stored as a small code instead of a Python string
+# Outcome of a label vs. ground truth (label_type_vec), and the RegEx search result (search_regex_all)
+outcome_type = pd.CategoricalDtype(["TP", "FP", "TN", "FN", "ERROR", ""])
+yesno_type = pd.CategoricalDtype(["Yes", "No", ""])
+
+# Initialize DataFrame columns
+# Label and Supporting_Quote hold the LLM's own text (it is not always exactly "Yes"/"No"), so they stay text columns
 def setupdf(df):
     df["Label"] = ""
     df["Supporting_Quote"] = ""
-    df["GPT_type"] = ""
-    df["Regex"] = ""
+    df["GPT_type"] = pd.Categorical([""] * len(df), dtype=outcome_type)
+    df["Regex"] = pd.Categorical([""] * len(df), dtype=yesno_type)
     df["Regex_match"] = ""
-    df["Regex_type"] = ""
-    df["EitherOr_type"] = ""
-    df[" "] = ""
-    df["calc"] = ""
-    df["calc_Label"] = ""
-    df["calc_Regex"] = ""
-    df["calc_EitherOr"] = ""
-    values = ['True Positive', 'True Negative', 'False Positive', 'False Negative','Specificity', 'SensitivityRecall',  'Precision', 'F1']
-    df.iloc[1:9, df.columns.get_loc('calc')] = values
+    df["Regex_type"] = pd.Categorical([""] * len(df), dtype=outcome_type)
+    df["EitherOr_type"] = pd.Categorical([""] * len(df), dtype=outcome_type)
     return df
 
 # Calculate statistics (specificity, precision, recall, F1) and format as percentages
+# Returns a separate small table of the metrics: one row per metric, one column per method (Label, Regex, EitherOr)
 def calcstats(df):
-    # Count classification outcomes for each method
-    #true positives
-    df.at[1, "calc_Label"] = (df['GPT_type'] == 'TP').sum()
-    df.at[1, "calc_Regex"] = (df['Regex_type'] == 'TP').sum()
-    df.at[1, "calc_EitherOr"] = (df['EitherOr_type'] == 'TP').sum()
-    #true negatives
-    df.at[2, "calc_Label"] = (df['GPT_type'] == 'TN').sum()
-    df.at[2, "calc_Regex"] = (df['Regex_type'] == 'TN').sum()
-    df.at[2, "calc_EitherOr"] = (df['EitherOr_type'] == 'TN').sum()
-    #False positives
-    df.at[3, "calc_Label"] = (df['GPT_type'] == 'FP').sum()
-    df.at[3, "calc_Regex"] = (df['Regex_type'] == 'FP').sum()
-    df.at[3, "calc_EitherOr"] = (df['EitherOr_type'] == 'FP').sum()
-    #false negatives
-    df.at[4, "calc_Label"] = (df['GPT_type'] == 'FN').sum()
-    df.at[4, "calc_Regex"] = (df['Regex_type'] == 'FN').sum()
-    df.at[4, "calc_EitherOr"] = (df['EitherOr_type'] == 'FN').sum()
-    #Specificity=(TN 2)/(TN 2 + FP 3)
-    df.at[5, "calc_Label"] = df.at[2,"calc_Label"] / (df.at[2,"calc_Label"] + df.at[3,"calc_Label"])
-    df.at[5, "calc_Regex"] = df.at[2,"calc_Regex"] / (df.at[2,"calc_Regex"] + df.at[3,"calc_Regex"])
-    df.at[5, "calc_EitherOr"] = df.at[2,"calc_EitherOr"] / (df.at[2,"calc_EitherOr"] + df.at[3,"calc_EitherOr"])
-    #Sensitivity/Recall=(TP 1)/(TP 1 + FN 4)
-    df.at[6, "calc_Label"] = df.at[1,"calc_Label"] / (df.at[1,"calc_Label"] + df.at[4,"calc_Label"])
-    df.at[6, "calc_Regex"] = df.at[1,"calc_Regex"] / (df.at[1,"calc_Regex"] + df.at[4,"calc_Regex"])
-    df.at[6, "calc_EitherOr"] = df.at[1,"calc_EitherOr"] / (df.at[1,"calc_EitherOr"] + df.at[4,"calc_EitherOr"])
-    #Precision = TP 1 / (TP 1 + FP 3)
-    df.at[7, "calc_Label"] = df.at[1,"calc_Label"] / (df.at[1,"calc_Label"] + df.at[3,"calc_Label"])
-    df.at[7, "calc_Regex"] = df.at[1,"calc_Regex"] / (df.at[1,"calc_Regex"] + df.at[3,"calc_Regex"])
-    df.at[7, "calc_EitherOr"] = df.at[1,"calc_EitherOr"] / (df.at[1,"calc_EitherOr"] + df.at[3,"calc_EitherOr"])
-    #F1 Score = 2 × (Precision × Recall) / (Precision + Recall)
-    df.at[8, "calc_Label"] = 2 * ( df.at[6,"calc_Label"] * df.at[7,"calc_Label"] ) / (df.at[6,"calc_Label"] + df.at[7,"calc_Label"])
-    df.at[8, "calc_Regex"] =  2 * ( df.at[6,"calc_Regex"] * df.at[7,"calc_Regex"] ) / (df.at[6,"calc_Regex"] + df.at[7,"calc_Regex"])
-    df.at[8, "calc_EitherOr"] =  2 * ( df.at[6,"calc_EitherOr"] * df.at[7,"calc_EitherOr"] ) / (df.at[6,"calc_EitherOr"] + df.at[7,"calc_EitherOr"])
+    # Count classification outcomes for each method in one pass per column
+    # mat rows: true positives, true negatives, false positives, false negatives; columns: Label, Regex, EitherOr
+    outcomes = ["TP", "TN", "FP", "FN"]
+    mat = np.stack([df[col].value_counts().reindex(outcomes, fill_value=0).to_numpy()
+                    for col in ["GPT_type", "Regex_type", "EitherOr_type"]], axis=1)
+    tp, tn, fp, fn = mat
+    with np.errstate(divide="ignore", invalid="ignore"):  # 0/0 gives NaN, left blank below
+        specificity = tn / (tn + fp)  # Specificity = TN / (TN + FP)
+        recall = tp / (tp + fn)  # Sensitivity/Recall = TP / (TP + FN)
+        precision = tp / (tp + fp)  # Precision = TP / (TP + FP)
+        f1 = 2 * (recall * precision) / (recall + precision)  # F1 Score = 2 × (Precision × Recall) / (Precision + Recall)
 
     # Format metrics as percentages with two decimal places
-    for row in [5, 6, 7, 8]:
-        for col in ["calc_Label", "calc_Regex", "calc_EitherOr"]:
-            val = df.at[row, col]
-            if pd.notnull(val):
-                df.at[row, col] = f"{val:.2%}"
-    return df
\ No newline at end of file
+    metrics = [[f"{val:.2%}" if pd.notnull(val) else "" for val in row] for row in [specificity, recall, precision, f1]]
+    return pd.DataFrame([list(row) for row in mat] + metrics, columns=["Label", "Regex", "EitherOr"],
+                        index=pd.Index(['True Positive', 'True Negative', 'False Positive', 'False Negative',
+                                        'Specificity', 'SensitivityRecall', 'Precision', 'F1'], name="calc"))
+
+
+# Send notes to the LLM directly, batch_size notes per API call
+# analyze(notes, model) makes the call for one group of notes and returns one output per note (e.g. analyze_symptoms_batch);
+# store(idx, output) stores one note's output as soon as its group finishes (output is None if the call failed)
+# max_concurrent workers each take the next group of notes from a queue (how many call the API at once is set by label_concurrency)
+async def label_notes_online(notes, models, analyze, store, max_concurrent=max_concurrent, batch_size=20, desc="Identifying Symptom"):
+    queue = asyncio.Queue()
+    for group in group_notes(notes.index, notes, batch_size, models=models):
+        queue.put_nowait(group)
+    progress = tqdm(total=queue.qsize(), desc=desc)
+
+    async def worker():
+        while not queue.empty():
+            idxs, group, model = queue.get_nowait()
+            try:
+                outputs = await analyze(group, model)
+            except Exception as e:
+                print(f"Error at rows {idxs[0]}-{idxs[-1]}: {e}")
+                outputs = [None] * len(idxs)
+            for idx, output in zip(idxs, outputs):
+                store(idx, output)
+            progress.update(1)
+
+    await asyncio.gather(*[worker() for _ in range(max_concurrent)])
+    progress.close()
+
+# Set up one task's results on a copy of df (so several tasks can be run on the same loaded notes) and run its RegEx search
+# prompt_text: the instructions the notes are sent with (the task's own, or the fused instructions, see run_tasks_fused)
+# Returns the results, the model for each note (see note_models), the models to send the notes with
+# (None for notes already in the task's partial results file and empty notes), and each note's label_key (see load_partial)
+def prepare_task(df, task, prompt_text):
+    # Add/initialize required columns
+    df = setupdf(df.copy())
+    # run regex on all notes at once, before the LLM
+    df["Regex"], df["Regex_match"] = search_regex_all(df["note"], task["pattern"])  # Regex search for keywords: yes/no and match string(s)
+    models = note_models(df["Regex"], task.get("regex_hit_model", "gpt-4o"))
+    if task.get("vocab_pattern") is not None or task.get("denial_pattern") is not None:
+        models = prefilter_models(df["note"], df["Regex"], models, task.get("vocab_pattern"), task.get("denial_pattern"))
+
+    # Labels from an earlier, stopped run are loaded from the partial results file; only the other notes go to the LLM
+    # (notes with model None are not sent to the LLM, so they have no key and nothing is resumed for them)
+    keys = {idx: label_key(prompt_text, note, model) for idx, note, model in zip(df.index, df["CleanNote6"], models)
+            if model is not None}
+    done = load_partial(df, task["partial_file"], keys)
+    llm_models = [None if idx in done else model for idx, model in zip(df.index, models)]
+    llm_models = skip_empty_notes(df, df["CleanNote6"], llm_models)  # empty notes: "No", not sent
+    return df, models, llm_models, keys
+
+# After the LLM labels are in: label the notes not sent to the LLM from the RegEx search, compare to the ground truth,
+# print the metrics, and save the results (see save_output)
+# run_task / run_tasks_fused run it in a separate thread, so other tasks' API calls keep going while one task saves its results
+def finish_task(df, task, models):
+    df = fill_regex_labels(df, models)
+
+    # compare to ground truth & create either/or
+    truth = df[task["truth_col"]]
+    df["GPT_type"] = label_type_vec(truth, df["Label"])  # Compare LLM label to ground truth
+    df["Regex_type"] = label_type_vec(truth, df["Regex"])  # Compare regex result to ground truth
+    df["EitherOr_type"] = label_type_ei_vec(truth, df["Label"], df["Regex"])  # Combined logic
+
+    # Calculate F1 and other statistics, kept in a separate small table
+    metrics = calcstats(df)
+    # each message written in one piece (newline included), so the output of tasks finishing at the same time doesn't mix
+    print(f"{task['name']}:\n{metrics}\n", end="")
+
+    # Save the results (and a Parquet copy and the metrics, see save_output)
+    save_output(df, metrics, task["output_file"])
+    print(f"Results saved to: {task['output_file']}\n", end="")
+    return df, metrics
+
+# Run one identification task on the notes in df: RegEx search on the raw notes (note), LLM labels on the cleaned notes (CleanNote6),
+# both compared to the ground truth; prints the metrics and saves the results (see save_output)
+# task: dict of the task's settings (defined in each analysis script):
+#   - name: short name, used in messages and batch file names
+#   - prompt_text: instructions for the LLM
+#   - pattern: RegEx pattern
+#   - truth_col: ground truth column ("Yes"/"No")
+#   - partial_file: JSONL file each label is appended to as soon as it is done (see load_partial)
+#   - output_file: results CSV
+#   - regex_hit_model: LLM model for the notes the RegEx search flags (see note_models)
+#   - vocab_pattern, denial_pattern (optional): RegEx prefilter, only notes the RegEx search can't decide go to the LLM (see prefilter_models)
+# online: call the API directly (max_concurrent workers, batch_size notes per call); otherwise use the Batch API (input files in batch_dir)
+# Returns the results and the metrics
+async def run_task(df, task, online=True, batch_dir=None, max_concurrent=max_concurrent, batch_size=20):
+    prompt_text = task["prompt_text"]
+    df, models, llm_models, keys = prepare_task(df, task, prompt_text)
+    # Notes labeled in any earlier run (label_cache) are filled in, and identical notes are only sent once
+    llm_models, copies = dedupe_notes(df, df["CleanNote6"], llm_models, prompt_text)
+
+    # Each label is stored as soon as it is done and appended to the partial results file (see set_label)
+    labels = Labels(df, keys)
+    with open(task["partial_file"], "a", encoding="utf-8") as f:
+        def store(idx, output):
+            set_label(labels, f, idx, *(output or (None, None)), copies)  # also fills in identical notes (see dedupe_notes)
+
+        if online:
+            await label_notes_online(df["CleanNote6"], llm_models, lambda notes, model: analyze_symptoms_batch(notes, prompt_text, model),
+                                     store, max_concurrent, batch_size, desc=f"Identifying Symptom ({task['name']})")
+        else:
+            outputs = await analyze_symptoms_offline(df["CleanNote6"].tolist(), prompt_text, batch_dir, models=llm_models,
+                                                     batch_name=f"batch_input_{task['name']}")
+            for idx, model, output in zip(df.index, llm_models, outputs):
+                if model is not None:
+                    store(idx, output)
+    labels.write_to(df)
+    return await asyncio.to_thread(finish_task, df, task, models)
+
+# Instructions for several tasks answered in one LLM call (see run_tasks_fused): each task's instructions under its name,
+# then how to answer: one line per task, starting with the task name
+def fused_prompt(tasks):
+    names = [task["name"].upper() for task in tasks]
+    # each task's prompt without its closing "EHR Note:" line (the notes come after all the tasks)
+    instructions = [re.sub(r"EHR Note:\s*$", "", task["prompt_text"].strip()).strip() for task in tasks]
+    parts = [f"### TASK {name}\n{text}" for name, text in zip(names, instructions)]
+    return ("You will answer " + str(len(tasks)) + " separate tasks about the same clinical note(s).\n\n" + "\n\n".join(parts)
+            + "\n\n**OUTPUT INSTRUCTIONS FOR ALL TASKS:**\nAnswer every task above separately, one line per task, starting with the task name, "
+            + "in the format:  NAME: Yes | [brief supporting quote from the note]  or  NAME: No\n"
+            + "Task names: " + ", ".join(names) + "\n\nEHR Note:\n")
+
+# Parse "NAME: label | quote" lines into one (label, quote) per task; tasks missing from the answer get "Error"
+def parse_task_labels(lines, names):
+    labels = {}
+    for line in lines:
+        match = re.match(r"\s*(?:-\s*)?([A-Za-z0-9_]+)\s*:\s*(.*)", line)
+        if match and match.group(1).upper() in names:
+            labels[match.group(1).upper()] = parse_label(match.group(2))
+    return [labels.get(name, ("Error", "")) for name in names]
+
+# Several tasks for several EHR notes in one API call (the multi-task version of analyze_symptoms_batch)
+# Returns a list with, for each note, one (label, quote) per task; empty or missing notes are not sent ("No")
+async def analyze_tasks_batch(notes, tasks, model="gpt-4o"):
+    names = [task["name"].upper() for task in tasks]
+    results = [[("No", "")] * len(tasks) if pd.isna(note) or not str(note).strip() else [("Error", "")] * len(tasks) for note in notes]
+    numbers = [i for i, note in enumerate(notes, start=1) if results[i - 1][0][0] == "Error"]
+    if not numbers:
+        return results
+
+    # Construct the prompt for the LLM: each note with its number (the instructions are sent first, in their own message)
+    prompt = "\n".join(f'### NOTE {i}\n"""{notes[i - 1]}"""' for i in numbers)
+    prompt += (f"\n\nAnswer every task for each of the {len(numbers)} notes above separately. Output one line per note and task, "
+               f"starting with the note number, in the format: i: NAME: Yes | [brief supporting quote from the note]  or  i: NAME: No")
+    try:
+        response = await request_label(fused_prompt(tasks), prompt, model, n_answers=len(numbers) * len(tasks))
+
+        # Clean and parse the LLM's output, one "i: NAME: label | quote" line per note and task
+        lines = {}
+        raw_output = response.choices[0].message.content.strip()
+        for line in re.sub(r"[\*\`]", "", raw_output).splitlines():
+            match = re.match(r"\s*(?:-\s*)?(?:NOTE\s*)?(\d+)\s*[:.)]\s*(.*)", line, re.IGNORECASE)
+            if match and int(match.group(1)) in numbers:
+                lines.setdefault(int(match.group(1)), []).append(match.group(2))
+        # With a single note, the LLM may answer "NAME: label | quote" lines without the note number
+        if len(numbers) == 1 and not lines:
+            lines[numbers[0]] = re.sub(r"[\*\`]", "", raw_output).splitlines()
+        for i, note_lines in lines.items():
+            results[i - 1] = parse_task_labels(note_lines, names)
+        return results
+
+    except Exception as e:
+        print(f"Error processing notes: {e}")
+        return results  # Return error labels if something goes wrong
+
+# A task's settings for run_tasks_fused: its partial results and output files get a "_fused" suffix,
+# so fused answers are kept apart from the task's single-task results (and a later single-task run doesn't resume from them)
+def fused_task(task):
+    return dict(task, partial_file=os.path.splitext(task["partial_file"])[0] + "_fused" + os.path.splitext(task["partial_file"])[1],
+                output_file=os.path.splitext(task["output_file"])[0] + "_fused" + os.path.splitext(task["output_file"])[1])
+
+# Run several tasks on the same notes with one LLM call per note (group of notes) for all of them, instead of one call per task
+# (e.g. LGBTQ+ identity and prior hospitalizations from the same CleanNote6 notes: half the calls, the notes are only sent once)
+# Each task keeps its own RegEx search, partial results file, metrics, and output file (as in run_task, named by fused_task)
+# A note is sent if any task still needs it, with the model of the first task that needs it; identical notes are sent once
+# Fused answers are not saved in label_cache (they answer a different prompt than the single-task runs)
+# Returns a list of (results, metrics), one per task
+async def run_tasks_fused(df, tasks, online=True, batch_dir=None, max_concurrent=max_concurrent, batch_size=20):
+    tasks = [fused_task(task) for task in tasks]
+    prompt_text = fused_prompt(tasks)
+    names = [task["name"].upper() for task in tasks]
+    prepared = [prepare_task(df, task, prompt_text) for task in tasks]
+    fused_models = [next((model for model in note_models if model is not None), None)
+                    for note_models in zip(*[llm_models for _, _, llm_models, _ in prepared])]
+    # Identical notes are sent once (the prompt is unique to this set of tasks, so nothing is in label_cache yet)
+    fused_models, copies = dedupe_notes(prepared[0][0], df["CleanNote6"], fused_models, prompt_text)
+
+    task_labels = [Labels(task_df, keys) for task_df, _, _, keys in prepared]
+    partial_files = [open(task["partial_file"], "a", encoding="utf-8") for task in tasks]
+    try:
+        # Store each task's label for the note (only for the tasks that still needed it) and append it to that task's partial results file
+        def store(idx, output):
+            for i in [idx] + copies.get(idx, []):
+                pos = task_labels[0].position[i]
+                for (_, _, llm_models, _), labels, f, (label, quote) in zip(prepared, task_labels, partial_files,
+                                                                         output or [(None, None)] * len(tasks)):
+                    if llm_models[pos] is not None:
+                        set_label(labels, f, i, label, quote, {})
+
+        if online:
+            await label_notes_online(df["CleanNote6"], fused_models, lambda notes, model: analyze_tasks_batch(notes, tasks, model),
+                                     store, max_concurrent, batch_size, desc="Identifying Symptoms (" + ", ".join(names) + ")")
+        else:
+            # Batch API: the fused instructions and one note per request, answered as "NAME: label | quote" lines
+            outputs = await analyze_symptoms_offline(df["CleanNote6"].tolist(), prompt_text, batch_dir, models=fused_models,
+                                                     batch_name="batch_input_" + "_".join(task["name"] for task in tasks),
+                                                     parse=lambda raw_output: parse_task_labels(re.sub(r"[\*\`]", "", raw_output).splitlines(), names),
+                                                     n_answers=len(tasks))
+            for idx, model, output in zip(df.index, fused_models, outputs):
+                if model is not None:
+                    store(idx, None if output == ("Error", "") else output)
+    finally:
+        for f in partial_files:
+            f.close()
+    for (task_df, _, _, _), labels in zip(prepared, task_labels):
+        labels.write_to(task_df)
+    return list(await asyncio.gather(*[asyncio.to_thread(finish_task, task_df, task, models)
+                                       for task, (task_df, models, _, _) in zip(tasks, prepared)]))
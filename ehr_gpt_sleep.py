@@ -4,24 +4,20 @@
 # This script runs LLM and RegEx identification of sleep problems
 
 #Load Libraries
-from openai import AsyncOpenAI # connects to OpenAI's GPT API
 import os #interact with the underlying operating system
+import re # regex keyword search
 import pandas as pd # handles spreadsheet data
-import asyncio # enables parallel processing
-from tqdm.asyncio import tqdm_asyncio # shows progress bars (optional)
-import ehr_gpr_funs as ehr # load internal functions defined in ehr_gpt_funs.py
+import ehr_gpt_funs as ehr # load internal functions defined in ehr_gpt_funs.py
 
 # time how long script takes to run (optional)
 import time
-start_time = time.time()  # Start timer
 # check max RAM usage (optional)
 import psutil
-process = psutil.Process(os.getpid())
 
 
 # Set your OpenAI API key from environment variable
 #openai.api_key = os.getenv("OPENAI_API_KEY")
-client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# API calls use the shared client in ehr_gpt_funs.py (ehr.get_client())
 # Set system context for the language model (from your helper module)
 #system_content = ehr.system_content
 
@@ -29,16 +25,18 @@ client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 script_dir = os.path.dirname(os.path.abspath(__file__))
 
 # Build the path to your input CSV file - output of cleaning step (relative to script location)
-input_file = os.path.join(script_dir, "/data/cleaned_output.csv")
+input_file = os.path.join(script_dir, "../data/cleaned_output.csv")
 
-# Load the CSV file into a pandas DataFrame
-df = pd.read_csv(input_file)
+# Each LLM label is appended to this JSONL file as soon as it is done, so a crash or stopped run loses nothing:
+# re-running the script skips the notes already in the file (delete the file to label all notes again)
+partial_file = os.path.join(script_dir, "../data/ehr_sleep_partial.jsonl")
 
-# Add/initialize required columns to the DataFrame (custom function)
-df = ehr.setupdf(df)
+# Save the results to a new CSV file in the data directory (and a Parquet copy and the metrics, see ehr.save_output)
+output_file = os.path.join(script_dir, "../data/ehr_sleep_out.csv")
 
 # Define the prompt text for the language model (multi-line string)
-prompt_text = f"""
+# Sent unchanged, as its own message, before every note so OpenAI can reuse it from its prompt cache
+prompt_text = """
 You are a clinical language model trained to analyze psychiatric electronic health records from the pediatric emergency room.
 
 Task: Determine if there is **any explicit evidence** in the following clinical note for **sleep difficulties**. Only base your answer on what is explicitly stated in the note. 
@@ -86,55 +84,51 @@ Respond strictly in one of these formats only, with no extra text or formatting:
 EHR Note:
 """
 
-# Define the regex pattern
-pattern = r"\b(insomnia|hypersomnia|somnolent|somnolence|G47|poor sleep|narcolepsy|poor sleep|irregular sleep|sleep aid|melatonin|sleepwake|sleep apnea|sleep disorder|awakening|difficulty sleeping|trouble sleeping|non[-\s]?restorative|sleepiness|night terrors|sleep disturbance|decreased sleep)\b"
-
-#define function to run gpt prompt on all records
-async def process_all_notes(df, max_concurrent):
-    semaphore = asyncio.Semaphore(max_concurrent)
-
-    async def process_note(idx, note):
-        async with semaphore:
-            try:
-                outputs = await ehr.analyze_symptom_parallel(note, prompt_text)
-                return idx, outputs
-            except Exception as e:
-                print(f"Error at row {idx}: {e}")
-                return idx, (None, None)
-    
-    tasks = [process_note(idx, row["CleanNote6"]) for idx, row in df.iterrows()]
-    results = []
-    for coro in tqdm_asyncio.as_completed(tasks, total=len(tasks), desc="Identifying Symptom"):
-        result = await coro
-        results.append(result)
-
-    for idx, (p1, p2) in results:
-        df.at[idx, "Label"] = p1
-        df.at[idx, "Supporting_Quote"] = p2
-
-## RUN PARALLEL PROCESSING ON ALL NOTES
-asyncio.run(process_all_notes(df, max_concurrent=10))  # 10 parallel processes
-# run regex on each row of data & create either/or
-for idx, row in df.iterrows():
-    note = row["note"]  # Get the clinical note text
-    regexyesno, regexmatch = ehr.search_regex(note, pattern)  # Regex search for keywords
-    df.at[idx, 'GPT_type'] = ehr.label_type(df.at[idx, 'sleep'], df.at[idx, 'Label'])  # Compare LLM label to ground truth
-    df.at[idx, "Regex"] = regexyesno  # Store regex yes/no
-    df.at[idx, "Regex_match"] = regexmatch  # Store regex match string(s)
-    df.at[idx, 'Regex_type'] = ehr.label_type(df.at[idx, 'sleep'], regexyesno)  # Compare regex result to ground truth
-    df.at[idx, 'EitherOr_type'] = ehr.label_type_ei(df.at[idx, 'sleep'], df.at[idx, 'Label'], regexyesno)  # Combined logic
-
-# Calculate F1 and other statistics (custom function)
-df = ehr.calcstats(df)
-
-# Save the results to a new CSV file in the data directory
-output_file = os.path.join(script_dir, "../data/ehr_sleep_out.csv")
-df.to_csv(output_file, index=False)
-print(f"Results saved to: {output_file}")
-
-end_time = time.time()    # End timer
-print(f"Script runtime: {end_time - start_time:.2f} seconds")
-mem_info = process.memory_info()
-print(f"Peak memory usage: {mem_info.rss / (1024 ** 2):.2f} MB")
-cpu_percent = process.cpu_percent(interval=1.0)
-print(f"CPU usage: {cpu_percent}%")
\ No newline at end of file
+# Define the regex pattern (compiled once, case-insensitive)
+pattern = re.compile(r"\b(?:insomnia|hypersomnia|somnolent|somnolence|G47|poor sleep|narcolepsy|irregular sleep|sleep aid|melatonin|sleepwake|sleep apnea|sleep disorder|awakening|difficulty sleeping|trouble sleeping|non[-\s]?restorative|sleepiness|night terrors|sleep disturbance|decreased sleep)\b", re.IGNORECASE)
+
+# Settings for this task, run by ehr.run_task (ehr_gpt_all.py imports them to run several tasks at once)
+task = {"name": "sleep",
+        "prompt_text": prompt_text,
+        "pattern": pattern,
+        "truth_col": "sleep",
+        "partial_file": partial_file,
+        "output_file": output_file,
+        # LLM model for the notes the regex already flagged (Regex == "Yes"), which the either/or result counts as positive anyway
+        #   - "gpt-4o": same model as all other notes, so GPT_type / the Label metrics cover every note (as in the manuscript)
+        #   - "gpt-4o-mini": cheaper model for these notes
+        #   - None: no LLM call for these notes; Label is "Yes" with the regex match as the supporting quote
+        #     (GPT_type / the Label metrics then only measure the LLM on the notes the regex missed)
+        "regex_hit_model": "gpt-4o",
+        # Optional RegEx prefilter (see ehr.prefilter_models), off (None) as in the manuscript; to use it, e.g.:
+        #   "vocab_pattern": re.compile(r"\b(?:sleep\w*|slept|asleep|nap\w*|tired|fatigue\w*|awake\w*|waking|wakes|bedtime|night\w*|dream\w*|rest\w*)\b", re.IGNORECASE),
+        #   "denial_pattern": re.compile(r"\b(?:deny|denies|denied|no history)\b.{0,40}sleep", re.IGNORECASE),
+        # (with "regex_hit_model": None, regex hits are then only sent to the LLM when a denial is nearby)
+        "vocab_pattern": None,
+        "denial_pattern": None}
+
+if __name__ == "__main__":
+    start_time = time.time()  # Start timer
+    process = psutil.Process(os.getpid())
+
+    # Stop now if the file or a needed column is missing (before any API calls)
+    ehr.check_input(input_file, ["CleanNote6", "sleep"])
+
+    # Load the CSV file into a pandas DataFrame
+    df = pd.read_csv(input_file, engine="pyarrow", dtype_backend="pyarrow")
+
+    # The cleaning output only has a hash of each raw note (note_sha), unless it was run with --debug-intermediates
+    # Get the raw notes, used for the RegEx search, from the cleaning input file
+    if "note" not in df.columns:
+        df = ehr.add_raw_notes(df, os.path.join(script_dir, "../data/input.csv"))
+
+    ## RUN PARALLEL PROCESSING ON ALL NOTES
+    # RegEx search, LLM labels, comparison to ground truth, metrics, and saving the results (see ehr.run_task)
+    ehr.run_with_client(ehr.run_task(df, task, max_concurrent=ehr.max_concurrent))  # EHR_MAX_CONCURRENT workers, calls at once set by ehr.label_concurrency
+
+    end_time = time.time()    # End timer
+    print(f"Script runtime: {end_time - start_time:.2f} seconds")
+    mem_info = process.memory_info()
+    print(f"Peak memory usage: {mem_info.rss / (1024 ** 2):.2f} MB")
+    cpu_percent = process.cpu_percent(interval=1.0)
+    print(f"CPU usage: {cpu_percent}%")
\ No newline at end of file